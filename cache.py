@@ -0,0 +1,146 @@
+import json
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+from config import CONFIG
+
+
+class MemoryCache():
+    # in-process LRU cache
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class DiskCache():
+    # one JSON file per entry, shared by all workers on the machine;
+    # the least recently used files are removed beyond max_size
+    def __init__(self, cache_dir, max_size=1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def get(self, key):
+        path = self.cache_dir / f'{key}.json'
+        try:
+            with path.open() as f:
+                value = json.load(f)
+            path.touch()
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def set(self, key, value):
+        path = self.cache_dir / f'{key}.json'
+        # a unique temporary file, the workers of a machine may write the
+        # same key at once
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir,
+                                         suffix='.tmp', delete=False) as f:
+            json.dump(value, f)
+        Path(f.name).replace(path)
+
+        paths = list(self.cache_dir.glob('*.json'))
+        if len(paths) > self.max_size:
+            paths.sort(key=lambda p: p.stat().st_mtime)
+            for p in paths[:len(paths) - self.max_size]:
+                p.unlink(missing_ok=True)
+
+
+class RedisCache():
+    # any server speaking the Redis protocol; eviction is left to the
+    # server (e.g. maxmemory-policy allkeys-lru), entries expire after ttl
+    def __init__(self, url, ttl=None, prefix='infographic:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+
+class ResultCache():
+    def __init__(self, backend):
+        self.backend = backend
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**kwargs):
+        payload = json.dumps(kwargs, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, key, compute):
+        value = self.backend.get(key)
+        if value is not None:
+            return value
+
+        # identical requests in flight wait for the first one. each lock
+        # counts the requests holding or waiting for it and is removed by
+        # the last one, also when compute() raises
+        with self._locks_lock:
+            lock, count = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[key] = (lock, count + 1)
+        try:
+            with lock:
+                value = self.backend.get(key)
+                if value is None:
+                    value = compute()
+                    self.backend.set(key, value)
+        finally:
+            with self._locks_lock:
+                lock, count = self._locks[key]
+                if count == 1:
+                    del self._locks[key]
+                else:
+                    self._locks[key] = (lock, count - 1)
+        return value
+
+
+def get_checkpoint_id(ckpt_path):
+    # results depend on the weights, so a rewritten checkpoint gets new keys
+    stat = Path(ckpt_path).stat()
+    return f'{Path(ckpt_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def get_result_cache(config=CONFIG):
+    backend = config['RESULT_CACHE']
+    if backend == 'memory':
+        return ResultCache(MemoryCache(config['RESULT_CACHE_SIZE']))
+
+    elif backend == 'disk':
+        return ResultCache(DiskCache(config['RESULT_CACHE_DIR'],
+                                     config['RESULT_CACHE_SIZE']))
+
+    elif backend == 'redis':
+        return ResultCache(RedisCache(config['REDIS_URL'],
+                                      config['RESULT_CACHE_TTL']))
+
+    elif backend == 'none':
+        return None
+
+    raise NotImplementedError(backend)
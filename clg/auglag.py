@@ -5,7 +5,7 @@ from torch_geometric.utils import to_dense_batch
 class AugLagMethod():
     def __init__(self, netG, netD, inner_optimizer, constraints,
                  alpha=3., l0=0., m0=1., iteration=15, tolerance=1e-8,
-                 clamp_f=True, raise_error_if_failed=False):
+                 clamp_f=True, raise_error_if_failed=False, stay_close=10.):
         self.netG = netG
         self.netD = netD
         self.inner_optimizer = inner_optimizer
@@ -21,6 +21,11 @@ class AugLagMethod():
         self._f0 = None
         self.raise_error = raise_error_if_failed
 
+        # weight of the penalty keeping fixed boxes close to bbox_ref
+        self.stay_close = stay_close
+        self._bbox_ref = None
+        self._keep_mask = None
+
         # bbox_canvas: [1, 1, 4]
         self.bbox_canvas = torch.tensor(
             [[[.5, .5, 1., 1.]]],
@@ -31,6 +36,16 @@ class AugLagMethod():
         f = -torch.sigmoid(self.netD(bbox, label, padding_mask))
         return f
 
+    def g(self, bbox):
+        # bbox: [B, N, 4] or [B, P, N, 4]
+        if self._bbox_ref is None:
+            return torch.zeros(bbox.size()[:-2]).to(bbox)
+        bbox_ref, keep = self._bbox_ref, self._keep_mask.float()
+        if len(bbox.size()) == 4:
+            bbox_ref, keep = bbox_ref.unsqueeze(1), keep.unsqueeze(1)
+        dist = (bbox - bbox_ref).square().sum(dim=-1)
+        return self.stay_close * (dist * keep).sum(dim=-1)
+
     def h(self, bbox, data, mask_c):
         B = bbox.size(0)
         canvas = self.bbox_canvas.to(bbox.device)
@@ -59,7 +74,7 @@ class AugLagMethod():
             h = self.h(bbox, data, mask_c)
 
             h_sqr = h.square().sum(dim=-1)
-            L = f + (l * h).sum(dim=-1) + m / 2 * h_sqr
+            L = f + (l * h).sum(dim=-1) + m / 2 * h_sqr + self.g(bbox)
 
             return L
         return objective
@@ -81,17 +96,21 @@ class AugLagMethod():
             f = self.f(bbox, _label, _padding_mask).view(B, P)
             if self.clamp_f:
                 f = torch.relu(f - self._f0[:f.size(0)])
-            h = self.h(bbox.view(B, P, N, D), data, mask_c)
+            bbox = bbox.view(B, P, N, -1)
+            h = self.h(bbox, data, mask_c)
 
             h_sqr = h.square().sum(dim=-1)
             lh = (l.unsqueeze(1) * h).sum(dim=-1)
-            L = f + lh + m / 2 * h_sqr
+            L = f + lh + m / 2 * h_sqr + self.g(bbox)
 
             return L.cpu().numpy()
 
         return objective
 
-    def generator(self, z, data):
+    def generator(self, z, data, latent_mask=None, bbox_ref=None):
+        # latent_mask: [B, N], latents to optimize (default: all boxes)
+        # bbox_ref: [B, N, 4], boxes outside latent_mask are penalized
+        #   for moving away from these
         assert data.attr[0]['has_canvas_element']
 
         C = len(self.constraints)
@@ -104,6 +123,16 @@ class AugLagMethod():
         padding_mask = ~mask
         bbox = self.netG(z, label, padding_mask)
 
+        if latent_mask is None:
+            latent_mask = mask
+        else:
+            latent_mask = latent_mask & mask
+        if bbox_ref is not None:
+            self._bbox_ref = bbox_ref.to(bbox)
+            self._keep_mask = mask & ~latent_mask
+        else:
+            self._bbox_ref, self._keep_mask = None, None
+
         if self.clamp_f:
             self._f0 = self.f(bbox, label, padding_mask)
             if 'CMAES' in str(type(self.inner_optimizer)):
@@ -124,7 +153,8 @@ class AugLagMethod():
             objective = build(l, m, data, label, padding_mask, mask_c)
 
             _stop = stop.unsqueeze(-1).unsqueeze(-1)
-            iterator = self.inner_optimizer.generator(z, objective, mask=mask)
+            iterator = self.inner_optimizer.generator(z, objective,
+                                                      mask=latent_mask)
             for z_opt in iterator:
                 _z = torch.where(_stop, z, z_opt)
                 yield _z
@@ -144,7 +174,7 @@ class AugLagMethod():
         if self.raise_error and not stop.all():
             raise RuntimeError('Failed to find solution')
 
-    def optimize(self, z, data):
-        for z_opt in self.generator(z, data):
+    def optimize(self, z, data, latent_mask=None, bbox_ref=None):
+        for z_opt in self.generator(z, data, latent_mask, bbox_ref):
             pass
         return z_opt
@@ -213,19 +213,20 @@ def relation_size_lg(bbox_flatten, data, canvas=False):
     return _relation_size(RelSize.LARGER, cost_func, bbox_flatten, data, canvas)
 
 
-def _relation_loc_canvas(rel_value, cost_func, bbox_flatten, data):
+def _relation_loc_canvas(rel_value, cost_func, bbox_flatten, data, dim=1):
+    # dim selects the box centre the cost is on: 1 for yc, 0 for xc
     cond = data.y[data.edge_index[0]].eq(0)
     cond &= (data.edge_attr & 1 << rel_value).ne(0)
 
     if len(bbox_flatten.size()) == 3:
         cond = cond.unsqueeze(-1)
-        yc = bbox_flatten[:, :, 1]
+        c = bbox_flatten[:, :, dim]
     else:
-        yc = bbox_flatten[:, 1]
+        c = bbox_flatten[:, dim]
 
-    yc = yc[data.edge_index[1]]
+    c = c[data.edge_index[1]]
 
-    cost = cost_func(yc).masked_fill(~cond, 0)
+    cost = cost_func(c).masked_fill(~cond, 0)
     cost = to_dense_adj(data.edge_index, data.batch, cost)
     cost = cost.sum(dim=(1, 2))
 
@@ -256,6 +257,22 @@ def relation_loc_canvas_b(bbox_flatten, data):
     return _relation_loc_canvas(RelLoc.BOTTOM, cost_func, bbox_flatten, data)
 
 
+def relation_loc_canvas_l(bbox_flatten, data):
+    def cost_func(xc):
+        # xc <= x_sm
+        x_sm = 1. / 3
+        return less_equal(xc, x_sm)
+    return _relation_loc_canvas(RelLoc.LEFT, cost_func, bbox_flatten, data, dim=0)
+
+
+def relation_loc_canvas_r(bbox_flatten, data):
+    def cost_func(xc):
+        # x_lg <= xc
+        x_lg = 2. / 3
+        return less_equal(x_lg, xc)
+    return _relation_loc_canvas(RelLoc.RIGHT, cost_func, bbox_flatten, data, dim=0)
+
+
 def _relation_loc(rel_value, cost_func, bbox_flatten, data):
     cond = data.y[data.edge_index[0]].ne(0)
     cond &= (data.edge_attr & 1 << rel_value).ne(0)
@@ -330,6 +347,8 @@ relation = [
     relation_loc_canvas_t,
     relation_loc_canvas_c,
     relation_loc_canvas_b,
+    relation_loc_canvas_l,
+    relation_loc_canvas_r,
     relation_loc_t,
     relation_loc_b,
     relation_loc_l,
@@ -0,0 +1,74 @@
+import torch
+
+
+class LatentInversion():
+    # recover latents z such that netG(z, label) reproduces a given layout
+    def __init__(self, netG, lr=0.05, iteration=300, tolerance=1e-4,
+                 num_restarts=0, seed=None):
+        self.netG = netG
+        self.lr = lr
+        self.iteration = iteration
+        self.tolerance = tolerance
+        self.num_restarts = num_restarts
+        self.seed = seed
+
+    def error(self, bbox_pred, bbox, mask):
+        # mean squared error over the valid boxes of each layout: [B]
+        err = (bbox_pred - bbox).square().sum(dim=-1)
+        err = err.masked_fill(~mask, 0).sum(dim=-1)
+        return err / mask.float().sum(dim=-1).clamp(min=1)
+
+    def generator(self, z, bbox, label, padding_mask):
+        # yields (z, error) before every step until all layouts are within
+        # tolerance; z is updated in place, copy it to keep it
+        mask = ~padding_mask
+        z = z.detach().clone().requires_grad_(True)
+        optimizer = torch.optim.Adam([z], lr=self.lr)
+
+        with torch.enable_grad():
+            for _ in range(self.iteration):
+                optimizer.zero_grad()
+                err = self.error(self.netG(z, label, padding_mask),
+                                 bbox, mask)
+                done = err.detach().le(self.tolerance)
+                yield z.detach(), err.detach()
+                if done.all():
+                    break
+
+                err.sum().backward()
+                optimizer.step()
+
+    def invert(self, bbox, label, padding_mask, z=None):
+        # bbox: [B, N, 4]  label: [B, N]  padding_mask: [B, N]
+        # z: [B, N, D] initial latents (default: zeros, the prior mode)
+        # returns the best latents [B, N, D] and their errors [B]; layouts
+        # above tolerance are retried from random latents num_restarts times
+        B, N = label.size()
+        D = self.netG.fc_z.in_features
+        if z is None:
+            z = torch.zeros(B, N, D).to(bbox)
+
+        generator = torch.Generator(bbox.device)
+        if self.seed is not None:
+            generator.manual_seed(self.seed)
+        else:
+            generator.seed()
+
+        z_best = z.detach().clone()
+        err_best = torch.full((B,), float('inf')).to(bbox)
+        for restart in range(self.num_restarts + 1):
+            todo = err_best.gt(self.tolerance)
+            if not todo.any():
+                break
+            if restart > 0:
+                z = torch.randn(B, N, D, generator=generator,
+                                device=bbox.device)
+
+            idx = todo.nonzero(as_tuple=True)[0]
+            for _z, err in self.generator(z[idx], bbox[idx], label[idx],
+                                          padding_mask[idx]):
+                improved = err < err_best[idx]
+                z_best[idx[improved]] = _z[improved]
+                err_best[idx[improved]] = err[improved]
+
+        return z_best, err_best
@@ -1,4 +1,4 @@
-import cma
+import numpy as np
 import torch
 
 
@@ -7,7 +7,8 @@ class AdamOptimizer():
         self.lr = lr
         self.iteration = iteration
 
-    def generator(self, z, objective, **kwargs):
+    def generator(self, z, objective, mask=None, **kwargs):
+        # mask: [B, N], only these latents are updated (default: all)
         z = z.detach().requires_grad_(True)
         optimizer = torch.optim.Adam([z], lr=self.lr)
         for _ in range(self.iteration):
@@ -15,11 +16,13 @@ class AdamOptimizer():
                 z.grad.zero_()
             loss = objective(z)  # [B]
             loss.sum().backward()
+            if mask is not None:
+                z.grad.masked_fill_(~mask.unsqueeze(-1), 0)
             optimizer.step()
             yield z.detach().requires_grad_(False)
 
-    def optimize(self, z, objective, **kwargs):
-        for z_opt in self.generator(z, objective):
+    def optimize(self, z, objective, mask=None, **kwargs):
+        for z_opt in self.generator(z, objective, mask):
             pass
         return z_opt
 
@@ -33,37 +36,51 @@ class CMAESOptimizer():
         }
 
         self.seed = seed
-        if seed is not None:
-            # pycma issue #111
-            self.option['seed'] = seed + 1
 
     def generator(self, z, objective, mask, **kwargs):
+        # mask: [B, N], only these latents are searched, the others
+        # keep their values from z in every candidate
+        # cma pulls in scipy and matplotlib, keep it off the import path
+        import cma
+
         B, N, D = z.size()
         device = z.device
+        z = z.detach().cpu()
+        mask = mask.cpu()
+
+        # pycma samples from the global numpy RNG unless it is given its
+        # own randn, so every run gets a RandomState; seeded runs are
+        # then repeatable even while other runs go on in other threads
+        # (seed + 1: pycma issue #111)
+        seed = None if self.seed is None else self.seed + 1
+        option = dict(self.option, randn=np.random.RandomState(seed).randn)
 
         es_list = []
         for i in range(B):
-            x0 = z[i][mask[i]].flatten().cpu().numpy()
-            es = cma.CMAEvolutionStrategy(x0, self.sigma0, self.option)
+            x0 = z[i][mask[i]].flatten().numpy()
+            es = cma.CMAEvolutionStrategy(x0, self.sigma0, option)
             es_list.append(es)
 
-        x = torch.zeros(B, max(es.popsize for es in es_list), N * D)
-        x_best = torch.zeros(B, N * D)
+        P = max(es.popsize for es in es_list)
+        x = z.unsqueeze(1).repeat(1, P, 1, 1)
+        z_best = z.clone()
 
         while not all(es.stop() for es in es_list):
             x_list = []
             for i, es in enumerate(es_list):
                 _x = es.ask()
                 x_list.append(_x)
-                x[i, :es.popsize, :es.N] = torch.as_tensor(_x)
+                x[i, :es.popsize, mask[i]] = \
+                    torch.as_tensor(_x).to(x).view(es.popsize, -1, D)
 
             with torch.no_grad():
-                loss = objective(x)
+                loss = objective(x.view(B, P, N * D))
 
             for i, es in enumerate(es_list):
                 es.tell(x_list[i], loss[i, :es.popsize])
-                x_best[i, :es.N] = torch.as_tensor(es.best.x)
-            yield x_best.view(B, N, D).to(device)
+                z_best[i][mask[i]] = \
+                    torch.as_tensor(es.best.x).to(z_best).view(-1, D)
+            yield z_best.clone().to(device)
 
     def optimize(self, z, objective, mask, **kwargs):
         for z_opt in self.generator(z, objective, mask):
@@ -6,7 +6,14 @@ import torch
 GLOBAL_CONFIG = {
     "MODEL_PATH": "pretrained/layoutganpp_magazine.pth.tar",
     "USE_CUDE_IF_AVAILABLE": True,
-    "ROUND_DIGIT": 6
+    "ROUND_DIGIT": 6,
+    # result cache for seeded /generate and /edit requests:
+    # 'memory' (per worker LRU), 'disk', 'redis' or 'none'
+    "RESULT_CACHE": os.environ.get('RESULT_CACHE', 'memory'),
+    "RESULT_CACHE_SIZE": int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+    "RESULT_CACHE_DIR": os.environ.get('RESULT_CACHE_DIR', 'output/result_cache'),
+    "RESULT_CACHE_TTL": int(os.environ.get('RESULT_CACHE_TTL', 0)) or None,
+    "REDIS_URL": os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 }
 
 # Environment specific config, or overwrite of GLOBAL_CONFIG
@@ -1,20 +1,50 @@
-from data.rico import Rico
-from data.publaynet import PubLayNet
-from data.magazine import Magazine
-from data.infographic import Infographic
-
-
+# dataset modules are imported on demand so that `data.util` can be
+# used without pulling in torch_geometric datasets and pycocotools
 def get_dataset(name, split, transform=None):
     if name == 'rico':
+        from data.rico import Rico
         return Rico(split, transform)
 
     elif name == 'publaynet':
+        from data.publaynet import PubLayNet
         return PubLayNet(split, transform)
 
     elif name == 'magazine':
+        from data.magazine import Magazine
         return Magazine(split, transform)
 
     elif name == 'infographic':
+        from data.infographic import Infographic
         return Infographic(split, transform)
 
     raise NotImplementedError(name)
+
+
+def get_dense_dataset(name, split):
+    # memory-mapped alternative to get_dataset() without transforms,
+    # see data/dense.py
+    from data.dense import DenseLayoutDataset
+    return DenseLayoutDataset(name, split)
+
+
+def get_dataloader(dataset, **kwargs):
+    # data loader for a dataset of either kind, with the arguments of
+    # torch.utils.data.DataLoader
+    if hasattr(dataset, 'get_dataloader'):
+        return dataset.get_dataloader(**kwargs)
+
+    from torch_geometric.data import DataLoader
+    return DataLoader(dataset, **kwargs)
+
+
+def get_dense_batch(data, device):
+    # bbox [B, N, 4], label [B, N] and mask [B, N] on device from a batch
+    # of either kind of data loader
+    if isinstance(data, (tuple, list)):
+        return tuple(t.to(device, non_blocking=True) for t in data)
+
+    from torch_geometric.utils import to_dense_batch
+    data = data.to(device)
+    label, mask = to_dense_batch(data.y, data.batch)
+    bbox, _ = to_dense_batch(data.x, data.batch)
+    return bbox, label, mask
@@ -1,7 +1,23 @@
-import torch
-import seaborn as sns
+import os
+import pickle
+import hashlib
 from pathlib import Path
-from torch_geometric.data import InMemoryDataset
+
+import torch
+from torch_geometric.data import Data, InMemoryDataset
+
+from data.util import get_colors
+
+
+def _parse_task(task):
+    # runs in a worker: read the file once, and parse it only if its
+    # content changed since the cached result
+    parse_fn, path, cached_hash = task
+    content = Path(path).read_bytes()
+    content_hash = hashlib.sha1(content).hexdigest()
+    if content_hash == cached_hash:
+        return path, content_hash, False, None
+    return path, content_hash, True, parse_fn(Path(path).name, content)
 
 
 class BaseDataset(InMemoryDataset):
@@ -9,6 +25,11 @@ class BaseDataset(InMemoryDataset):
     _label2index = None
     _index2label = None
     _colors = None
+    # bump when the output of the annotation parser changes, so that the
+    # cached parse results are discarded
+    parse_version = 1
+    # processes used to parse annotation files (None: all cores)
+    num_workers = None
 
     def __init__(self, name, split, transform):
         assert split in ['train', 'val', 'test']
@@ -35,10 +56,7 @@ class BaseDataset(InMemoryDataset):
     @property
     def colors(self):
         if self._colors is None:
-            n_colors = self.num_classes
-            colors = sns.color_palette('husl', n_colors=n_colors)
-            self._colors = [tuple(map(lambda x: int(x * 255), c))
-                            for c in colors]
+            self._colors = get_colors(self.num_classes)
         return self._colors
 
     @property
@@ -57,3 +75,57 @@ class BaseDataset(InMemoryDataset):
 
     def process(self):
         raise NotImplementedError
+
+    def parse_files(self, paths, parse_fn):
+        # parse_fn(name, content: bytes) -> picklable result, must be a
+        # module level function. files are parsed by a process pool, and results
+        # are cached per file by content hash in <root>/cache/parsed.pkl,
+        # so only new or changed files are parsed again
+        cache_path = Path(self.root) / 'cache' / 'parsed.pkl'
+        cache = {}
+        if cache_path.exists():
+            with cache_path.open('rb') as fb:
+                cached = pickle.load(fb)
+            if cached['version'] == (parse_fn.__name__, self.parse_version):
+                cache = cached['files']
+
+        tasks = [(parse_fn, str(p), cache.get(Path(p).name, (None,))[0])
+                 for p in paths]
+        num_workers = self.num_workers or os.cpu_count()
+        if num_workers == 1 or len(tasks) <= 1:
+            outputs = list(map(_parse_task, tasks))
+        else:
+            import multiprocessing as mp
+            chunksize = max(1, len(tasks) // (num_workers * 16))
+            with mp.Pool(min(num_workers, len(tasks))) as pool:
+                outputs = pool.map(_parse_task, tasks, chunksize)
+
+        results, files, num_parsed = [], {}, 0
+        for path, content_hash, parsed, result in outputs:
+            name = Path(path).name
+            if not parsed:
+                result = cache[name][1]
+            num_parsed += parsed
+            files[name] = (content_hash, result)
+            results.append(result)
+
+        if num_parsed > 0 or len(files) != len(cache):
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix('.tmp')
+            with tmp_path.open('wb') as fb:
+                pickle.dump({
+                    'version': (parse_fn.__name__, self.parse_version),
+                    'files': files,
+                }, fb, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_path.replace(cache_path)
+        print(f'Parsed {num_parsed} of {len(files)} annotation files '
+              f'({len(files) - num_parsed} cached)')
+
+        return results
+
+    @staticmethod
+    def make_data(boxes, labels, attr):
+        data = Data(x=torch.tensor(boxes, dtype=torch.float),
+                    y=torch.tensor(labels, dtype=torch.long))
+        data.attr = attr
+        return data
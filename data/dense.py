@@ -0,0 +1,88 @@
+import torch
+import numpy as np
+from pathlib import Path
+from torch.utils.data import Dataset, DataLoader, BatchSampler, \
+    RandomSampler, SequentialSampler
+
+from data.util import get_colors
+from layout_store import LayoutStore
+
+
+class DenseLayoutDataset(Dataset):
+    # a split stored as a memory-mapped LayoutStore
+    # (data/dataset/<name>/processed/<split>.layouts), written from the
+    # processed .pt of the torch_geometric dataset on first use and
+    # whenever the .pt is newer. dataset[i] is a zero-copy (bbox, label)
+    # view of layout i, and dataset[indices] the dense batch
+    # bbox [B, N, 4], label [B, N], mask [B, N] as tensors, without
+    # building Data objects; see get_dataloader()
+    def __init__(self, name, split):
+        processed_dir = Path(f'data/dataset/{name}/processed')
+        self.path = processed_dir / f'{split}.layouts'
+        data_path = processed_dir / f'{split}.pt'
+        if not self.path.exists() or not data_path.exists() or \
+                self.path.stat().st_mtime < data_path.stat().st_mtime:
+            from data import get_dataset
+            self.convert(get_dataset(name, split), self.path)
+
+        self.store = LayoutStore.open(self.path)
+        self.num_classes = int(self.store.label.max()) + 1
+        self._colors = None
+
+    @staticmethod
+    def convert(dataset, out_path):
+        # the collated x, y and slices of an InMemoryDataset are already
+        # the columns of a LayoutStore
+        store = LayoutStore(dataset.data.x.numpy(), dataset.data.y.numpy(),
+                            dataset.slices['x'].numpy())
+        if len(dataset) != len(store):
+            store = store.select(list(dataset.indices()))
+        store.save(out_path)
+
+    def __getstate__(self):
+        # data loader workers open the file again instead of receiving a
+        # pickled copy of the arrays
+        state = self.__dict__.copy()
+        del state['store']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.store = LayoutStore.open(self.path)
+
+    @property
+    def colors(self):
+        if self._colors is None:
+            self._colors = get_colors(self.num_classes)
+        return self._colors
+
+    @property
+    def lengths(self):
+        return self.store.lengths
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0:
+            return self.store[idx]
+
+        bbox, label, mask = self.store.gather(idx)
+        return torch.from_numpy(bbox), torch.from_numpy(label), \
+            torch.from_numpy(mask)
+
+    def get_layouts(self):
+        # list of (bbox, label) tuples, the format of compute_maximum_iou
+        return list(self.store)
+
+    def get_dataloader(self, batch_size=1, shuffle=False, sampler=None,
+                       batch_sampler=None, drop_last=False, **kwargs):
+        # same arguments as DataLoader; every list of indices of the batch
+        # sampler is gathered in one call of __getitem__
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(self) if shuffle \
+                    else SequentialSampler(self)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        return DataLoader(self, batch_size=None, sampler=batch_sampler,
+                          **kwargs)
@@ -2,7 +2,6 @@ import json
 from pathlib import Path
 
 import torch
-from torch_geometric.data import Data
 
 from data.base import BaseDataset
 
@@ -16,49 +15,10 @@ class Infographic(BaseDataset):
         super().download()
 
     def process(self):
-
-        data_list = []
         raw_dir = Path(self.raw_dir) / 'semantic_annotations'
-        for json_path in sorted(raw_dir.glob('*.json')):
-            with json_path.open() as f:
-                ann = json.load(f)
-
-            W, H = ann['image_size']['width'], ann['image_size']['height'] 
-            boxes = []
-            labels = []
-            
-            elements = ann['annotations']
-
-            for element in elements:
-                # bbox
-                top = element['top']
-                left = element['left']
-                width = element['width']
-                height = element['height']
-
-                xc = left + width / 2
-                yc = top + height / 2
-
-                b = [xc / W, yc / H,
-                     width / W, height / H]
-                boxes.append(b)
-
-                # label
-                l = element['class_id']
-                labels.append(l)
-
-            boxes = torch.tensor(boxes, dtype=torch.float)
-            labels = torch.tensor(labels, dtype=torch.long)
-            print('BOX SIZES: ', boxes.size())
-            data = Data(x=boxes, y=labels)
-            data.attr = {
-                'name': json_path.name,
-                'width': W,
-                'height': H,
-                'filtered': False,
-                'has_canvas_element': False,
-            }
-            data_list.append(data)
+        results = self.parse_files(sorted(raw_dir.glob('*.json')),
+                                   parse_annotation)
+        data_list = [self.make_data(*r) for r in results]
 
         # shuffle with seed
         generator = torch.Generator().manual_seed(0)
@@ -70,3 +30,41 @@ class Infographic(BaseDataset):
         torch.save(self.collate(data_list[:s[0]]), self.processed_paths[0])
         torch.save(self.collate(data_list[s[0]:s[1]]), self.processed_paths[1])
         torch.save(self.collate(data_list[s[1]:]), self.processed_paths[2])
+
+
+def parse_annotation(name, content):
+    # returns (boxes, labels, attr) of one annotation file
+    ann = json.loads(content)
+
+    W, H = ann['image_size']['width'], ann['image_size']['height']
+    boxes = []
+    labels = []
+
+    elements = ann['annotations']
+
+    for element in elements:
+        # bbox
+        top = element['top']
+        left = element['left']
+        width = element['width']
+        height = element['height']
+
+        xc = left + width / 2
+        yc = top + height / 2
+
+        b = [xc / W, yc / H,
+             width / W, height / H]
+        boxes.append(b)
+
+        # label
+        l = element['class_id']
+        labels.append(l)
+
+    attr = {
+        'name': name,
+        'width': W,
+        'height': H,
+        'filtered': False,
+        'has_canvas_element': False,
+    }
+    return boxes, labels, attr
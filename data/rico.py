@@ -2,7 +2,6 @@ import json
 from pathlib import Path
 
 import torch
-from torch_geometric.data import Data
 
 from data.base import BaseDataset
 
@@ -39,69 +38,10 @@ class Rico(BaseDataset):
         super().download()
 
     def process(self):
-        data_list = []
         raw_dir = Path(self.raw_dir) / 'semantic_annotations'
-        for json_path in sorted(raw_dir.glob('*.json')):
-            with json_path.open() as f:
-                ann = json.load(f)
-
-            B = ann['bounds']
-            W, H = float(B[2]), float(B[3])
-            if B[0] != 0 or B[1] != 0 or H < W:
-                continue
-
-            def is_valid(element):
-                if element['componentLabel'] not in set(self.labels):
-                    return False
-
-                x1, y1, x2, y2 = element['bounds']
-                if x1 < 0 or y1 < 0 or W < x2 or H < y2:
-                    return False
-
-                if x2 <= x1 or y2 <= y1:
-                    return False
-
-                return True
-
-            elements = append_child(ann, [])
-            _elements = list(filter(is_valid, elements))
-            filtered = len(elements) != len(_elements)
-            elements = _elements
-
-            N = len(elements)
-            if N == 0 or 9 < N:
-                continue
-
-            boxes = []
-            labels = []
-
-            for element in elements:
-                # bbox
-                x1, y1, x2, y2 = element['bounds']
-                xc = (x1 + x2) / 2.
-                yc = (y1 + y2) / 2.
-                width = x2 - x1
-                height = y2 - y1
-                b = [xc / W, yc / H,
-                     width / W, height / H]
-                boxes.append(b)
-
-                # label
-                l = element['componentLabel']
-                labels.append(self.label2index[l])
-
-            boxes = torch.tensor(boxes, dtype=torch.float)
-            labels = torch.tensor(labels, dtype=torch.long)
-
-            data = Data(x=boxes, y=labels)
-            data.attr = {
-                'name': json_path.name,
-                'width': W,
-                'height': H,
-                'filtered': filtered,
-                'has_canvas_element': False,
-            }
-            data_list.append(data)
+        results = self.parse_files(sorted(raw_dir.glob('*.json')),
+                                   parse_annotation)
+        data_list = [self.make_data(*r) for r in results if r is not None]
 
         # shuffle with seed
         generator = torch.Generator().manual_seed(0)
@@ -114,3 +54,63 @@ class Rico(BaseDataset):
         torch.save(self.collate(data_list[:s[0]]), self.processed_paths[0])
         torch.save(self.collate(data_list[s[0]:s[1]]), self.processed_paths[1])
         torch.save(self.collate(data_list[s[1]:]), self.processed_paths[2])
+
+
+def parse_annotation(name, content):
+    # returns (boxes, labels, attr) of one annotation file, or None if
+    # the layout is skipped
+    ann = json.loads(content)
+
+    B = ann['bounds']
+    W, H = float(B[2]), float(B[3])
+    if B[0] != 0 or B[1] != 0 or H < W:
+        return None
+
+    def is_valid(element):
+        if element['componentLabel'] not in set(Rico.labels):
+            return False
+
+        x1, y1, x2, y2 = element['bounds']
+        if x1 < 0 or y1 < 0 or W < x2 or H < y2:
+            return False
+
+        if x2 <= x1 or y2 <= y1:
+            return False
+
+        return True
+
+    elements = append_child(ann, [])
+    _elements = list(filter(is_valid, elements))
+    filtered = len(elements) != len(_elements)
+    elements = _elements
+
+    N = len(elements)
+    if N == 0 or 9 < N:
+        return None
+
+    boxes = []
+    labels = []
+
+    for element in elements:
+        # bbox
+        x1, y1, x2, y2 = element['bounds']
+        xc = (x1 + x2) / 2.
+        yc = (y1 + y2) / 2.
+        width = x2 - x1
+        height = y2 - y1
+        b = [xc / W, yc / H,
+             width / W, height / H]
+        boxes.append(b)
+
+        # label
+        l = element['componentLabel']
+        labels.append(Rico.labels.index(l))
+
+    attr = {
+        'name': name,
+        'width': W,
+        'height': H,
+        'filtered': filtered,
+        'has_canvas_element': False,
+    }
+    return boxes, labels, attr
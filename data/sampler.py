@@ -0,0 +1,95 @@
+import torch
+from torch.utils.data import Sampler
+
+
+def get_lengths(dataset):
+    # number of elements of every layout, read from the collated storage
+    # of an InMemoryDataset without building the samples
+    if hasattr(dataset, 'lengths'):  # DenseLayoutDataset
+        return dataset.lengths.tolist()
+    slices = dataset.slices['x']
+    lengths = slices[1:] - slices[:-1]
+    return lengths[torch.as_tensor(list(dataset.indices()))].tolist()
+
+
+class BucketBatchSampler(Sampler):
+    # batches of layouts with the same number of elements, so that
+    # to_dense_batch does not pad. with max_tokens, a bucket of layouts
+    # with n elements uses batches of max(1, max_tokens // n) layouts
+    # instead of batch_size.
+    # shuffle=True shuffles within buckets and then the order of batches;
+    # the order depends on seed and set_epoch(), or on the global torch
+    # RNG if seed is None.
+    # with num_replicas > 1 every rank takes every num_replicas-th batch,
+    # repeating batches so that all ranks get the same number
+    def __init__(self, lengths, batch_size, shuffle=False, max_tokens=None,
+                 drop_last=False, seed=None, num_replicas=1, rank=0):
+        if shuffle and num_replicas > 1 and seed is None:
+            raise ValueError('a seed shared by all ranks is required '
+                             'to shuffle with num_replicas > 1')
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        self.buckets = {}
+        for i, n in enumerate(lengths):
+            self.buckets.setdefault(n, []).append(i)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batch_size(self, n):
+        if self.max_tokens is None:
+            return self.batch_size
+        return max(1, self.max_tokens // max(n, 1))
+
+    def get_batches(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            if self.seed is None:
+                generator.manual_seed(int(torch.randint(2 ** 62, ())))
+            else:
+                generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        for n in sorted(self.buckets.keys()):
+            indices = self.buckets[n]
+            if self.shuffle:
+                perm = torch.randperm(len(indices), generator=generator)
+                indices = [indices[i] for i in perm.tolist()]
+
+            size = self.get_batch_size(n)
+            for i in range(0, len(indices), size):
+                batch = indices[i:i + size]
+                if len(batch) < size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            perm = torch.randperm(len(batches), generator=generator)
+            batches = [batches[i] for i in perm.tolist()]
+
+        if self.num_replicas > 1:
+            batches += batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        # number of batches of one rank
+        num_batches = 0
+        for n, indices in self.buckets.items():
+            size = self.get_batch_size(n)
+            if self.drop_last:
+                num_batches += len(indices) // size
+            else:
+                num_batches += -(-len(indices) // size)
+        return -(-num_batches // self.num_replicas)
@@ -1,7 +1,5 @@
 import torch
-import random
 from enum import IntEnum
-from itertools import product, combinations
 
 from util import convert_xywh_to_ltrb
 
@@ -113,6 +111,12 @@ def get_rel_text(rel, canvas=False):
             ][index]
 
 
+def get_colors(n_colors):
+    import seaborn as sns
+    colors = sns.color_palette('husl', n_colors=n_colors)
+    return [tuple(map(lambda x: int(x * 255), c)) for c in colors]
+
+
 class LexicographicSort():
     def __call__(self, data):
         assert not data.attr['has_canvas_element']
@@ -131,6 +135,45 @@ class HorizontalFlip():
         return data
 
 
+# batched versions of the transforms above, applied after collation to
+# dense bbox [B, N, 4], label [B, N] and mask [B, N] tensors
+class BatchLexicographicSort():
+    def __call__(self, bbox, label, mask):
+        # sort by (top, left), ties keep their order as sorted() does.
+        # the rank of every box under the key (top, left, index) is counted
+        # pairwise, which needs no stable sort (torch.sort has none before
+        # 1.9) and is cheap for the few elements of a layout; padding goes
+        # last
+        l, t, _, _ = convert_xywh_to_ltrb(bbox.permute(2, 0, 1))
+        l = l.masked_fill(~mask, float('inf'))
+        t = t.masked_fill(~mask, float('inf'))
+        index = torch.arange(bbox.size(1), device=bbox.device)
+
+        # before[b, i, j]: box j comes before box i
+        ti, tj = t.unsqueeze(2), t.unsqueeze(1)
+        li, lj = l.unsqueeze(2), l.unsqueeze(1)
+        before = (tj < ti) | ((tj == ti) & ((lj < li) | (
+            (lj == li) & (index.view(1, 1, -1) < index.view(1, -1, 1)))))
+        rank = before.sum(dim=2)
+
+        idx = torch.empty_like(rank).scatter_(1, rank, index.expand_as(rank))
+        bbox = bbox.gather(1, idx.unsqueeze(-1).expand(-1, -1, 4))
+        label = label.gather(1, idx)
+        return bbox, label, mask
+
+
+class BatchHorizontalFlip():
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, bbox, label, mask):
+        # flip each layout with probability p
+        flip = torch.rand(bbox.size(0), device=bbox.device) < self.p
+        x = torch.where(flip.unsqueeze(-1), 1 - bbox[..., 0], bbox[..., 0])
+        bbox = torch.cat([x.unsqueeze(-1), bbox[..., 1:]], dim=-1)
+        return bbox, label, mask
+
+
 class AddCanvasElement():
     def __init__(self):
         self.x = torch.tensor([[.5, .5, 1., 1.]], dtype=torch.float)
@@ -144,78 +187,127 @@ class AddCanvasElement():
             data.attr['has_canvas_element'] = True
         return data
 
+
+def detect_size_relations(bi, bj):
+    # batched detect_size_relation: bi, bj [P, 4] -> [P]
+    a1, a2 = bi[:, 2] * bi[:, 3], bj[:, 2] * bj[:, 3]
+    a1_sm = (1 - REL_SIZE_ALPHA) * a1
+    a1_lg = (1 + REL_SIZE_ALPHA) * a1
+
+    rel = torch.full_like(a1, RelSize.EQUAL, dtype=torch.long)
+    rel[a2 <= a1_sm] = RelSize.SMALLER
+    rel[a1_lg <= a2] = RelSize.LARGER
+    return rel
+
+
+def detect_loc_relations(bi, bj, canvas):
+    # batched detect_loc_relation: bi, bj [P, 4], canvas [P] -> [P]
+    l1, t1, r1, b1 = convert_xywh_to_ltrb(bi.t())
+    l2, t2, r2, b2 = convert_xywh_to_ltrb(bj.t())
+
+    # later assignments take precedence, as earlier returns do
+    rel = torch.full_like(l1, RelLoc.CENTER, dtype=torch.long)
+    rel[r1 <= l2] = RelLoc.RIGHT
+    rel[r2 <= l1] = RelLoc.LEFT
+    rel[b1 <= t2] = RelLoc.BOTTOM
+    rel[b2 <= t1] = RelLoc.TOP
+
+    yc = bj[:, 1]
+    rel_canvas = torch.full_like(rel, RelLoc.CENTER)
+    rel_canvas[2. / 3 <= yc] = RelLoc.BOTTOM
+    rel_canvas[yc <= 1. / 3] = RelLoc.TOP
+
+    return torch.where(canvas, rel_canvas, rel)
+
+
 # randomly add relational constraints
 class AddRelation():
     def __init__(self, seed=None, ratio=0.1):
         self.ratio = ratio
-        self.generator = random.Random()
+        self.generator = None
         if seed is not None:
-            self.generator.seed(seed)
+            self.generator = torch.Generator().manual_seed(seed)
 
     def __call__(self, data):
         # N = number of boxes in layout
         N = data.x.size(0)
-        # print(data.x.size())
-        # print('=' * 20)
-        # print(N)
         has_canvas = data.attr['has_canvas_element']
 
-        rel_all = list(product(range(2), combinations(range(N), 2))) # get all possible pairs of boxes
-        size = int(len(rel_all) * self.ratio) # randomly choose self.ratio of boxes with relations
-        rel_sample = set(self.generator.sample(rel_all, size))
-        # the pairs of element indices with relational constraints
-        # SAMPLE:  {(0, (0, 3)), (1, (4, 5)), (0, (2, 4)), (0, (0, 4))} 
-        # take (0, (0, 3)) -> (0, 3) are the element indices, 0 means size relation, 1 means location relation
-        edge_index, edge_attr = [], []
-        rel_unk = 1 << RelSize.UNKNOWN | 1 << RelLoc.UNKNOWN
-        
-        for i, j in combinations(range(N), 2):
-            bi, bj = data.x[i], data.x[j]
-            canvas = data.y[i] == 0 and has_canvas
-
-            if (0, (i, j)) in rel_sample:
-                rel_size = 1 << detect_size_relation(bi, bj)
-            else:
-                rel_size = 1 << RelSize.UNKNOWN
-
-            if (1, (i, j)) in rel_sample:
-                rel_loc = 1 << detect_loc_relation(bi, bj, canvas)
-            else:
-                rel_loc = 1 << RelLoc.UNKNOWN
-
-            rel = rel_size | rel_loc # addition of rel_size and rel_loc
-
-            if rel != rel_unk:
-                edge_index.append((i, j))
-                edge_attr.append(rel)
-
-        data.edge_index = torch.as_tensor(edge_index).long()
-        data.edge_index = data.edge_index.t().contiguous()
-        data.edge_attr = torch.as_tensor(edge_attr).long()
+        # all pairs of boxes (i < j, in the order of combinations) and
+        # their relations; a relation (type t, pair p) is sampled with
+        # index t * P + p, t = 0 for size and 1 for location
+        i, j = torch.triu_indices(N, N, 1)
+        P = i.size(0)
+        size = int(2 * P * self.ratio)
+        sampled = torch.zeros(2 * P, dtype=torch.bool)
+        sampled[torch.randperm(2 * P, generator=self.generator)[:size]] = True
+        sampled_size, sampled_loc = sampled[:P], sampled[P:]
+
+        bi, bj = data.x[i], data.x[j]
+        canvas = (data.y[i] == 0) & has_canvas
+
+        rel_size = torch.where(sampled_size,
+                               detect_size_relations(bi, bj),
+                               torch.full_like(i, RelSize.UNKNOWN))
+        rel_loc = torch.where(sampled_loc,
+                              detect_loc_relations(bi, bj, canvas),
+                              torch.full_like(i, RelLoc.UNKNOWN))
+
+        keep = sampled_size | sampled_loc
+        data.edge_index = torch.stack([i[keep], j[keep]])
+        # int << Tensor needs torch 1.10, shift a tensor of ones instead
+        rel_size, rel_loc = rel_size[keep], rel_loc[keep]
+        data.edge_attr = (torch.ones_like(rel_size) << rel_size) \
+            | (torch.ones_like(rel_loc) << rel_loc)
         return data
 
+
 class AddCustomRelation():
     '''
-    box id_b has relation over box id_a (e.g. box id_b is smaller than box id_a)
+    box id_b has relation over box id_a (e.g. box id_b is smaller than box id_a),
+    id_a = 0 refers to the canvas element (e.g. box id_b is at top).
+    relations is a list of (id_a, id_b, relation), all solved jointly;
+    a size and a location relation on the same pair share one edge.
     '''
-    def __init__(self, id_a, id_b, relation): 
-        self.str_to_loc_relations = {'unknown': RelLoc.UNKNOWN, 'left': RelLoc.LEFT, 'top': RelLoc.TOP, 'right': RelLoc.RIGHT, 'bottom': RelLoc.BOTTOM, 'center': RelLoc.CENTER}
-        self.str_to_size_relations = {'unknown': RelSize.UNKNOWN, 'small': RelSize.SMALLER, 'equal': RelSize.EQUAL, 'larger': RelSize.LARGER}
-        self.id_a = id_a
-        self.id_b = id_b
-        self.relation = relation
+    str_to_loc_relations = {'left': RelLoc.LEFT, 'top': RelLoc.TOP, 'right': RelLoc.RIGHT, 'bottom': RelLoc.BOTTOM, 'center': RelLoc.CENTER}
+    str_to_size_relations = {'small': RelSize.SMALLER, 'equal': RelSize.EQUAL, 'larger': RelSize.LARGER}
+
+    def __init__(self, relations):
+        self.relations = relations
+
+    @classmethod
+    def is_valid_relation(cls, relation):
+        return relation in cls.str_to_loc_relations or relation in cls.str_to_size_relations
+
+    @classmethod
+    def find_conflict(cls, relations):
+        # first relation that gives a pair of boxes a second size or a
+        # second location relation (in either order of the pair), or None;
+        # only one of each can be encoded on the edge of a pair
+        seen = set()
+        for id_a, id_b, relation in relations:
+            key = (min(id_a, id_b), max(id_a, id_b), relation in cls.str_to_size_relations)
+            if key in seen:
+                return (id_a, id_b, relation)
+            seen.add(key)
+        return None
 
     def __call__(self, data):
-        print(data.x)
-        rel_loc = 1 << self.str_to_loc_relations.get(self.relation, RelLoc.UNKNOWN)
-        rel_size = 1 << self.str_to_size_relations.get(self.relation, RelLoc.UNKNOWN)
+        rel_size, rel_loc = {}, {}
+        for id_a, id_b, relation in self.relations:
+            if relation in self.str_to_size_relations:
+                rel_size[(id_a, id_b)] = self.str_to_size_relations[relation]
+            elif relation in self.str_to_loc_relations:
+                rel_loc[(id_a, id_b)] = self.str_to_loc_relations[relation]
+
         edge_index, edge_attr = [], []
-        rel_unk = 1 << RelSize.UNKNOWN | 1 << RelLoc.UNKNOWN
-        rel = rel_size | rel_loc
-        if rel != rel_unk:
-            edge_index.append((self.id_a, self.id_b))
+        for pair in sorted(set(rel_size) | set(rel_loc)):
+            rel = 1 << rel_size.get(pair, RelSize.UNKNOWN)
+            rel |= 1 << rel_loc.get(pair, RelLoc.UNKNOWN)
+            edge_index.append(pair)
             edge_attr.append(rel)
+
         data.edge_index = torch.as_tensor(edge_index).long()
-        data.edge_index = data.edge_index.t().contiguous()
+        data.edge_index = data.edge_index.view(-1, 2).t().contiguous()
         data.edge_attr = torch.as_tensor(edge_attr).long()
-        return data
\ No newline at end of file
+        return data
@@ -1,22 +1,109 @@
-import pickle
+import csv
+import json
 import argparse
 import numpy as np
 from pathlib import Path
+from itertools import chain
 from collections import defaultdict
 
 import torch
-from torch_geometric.data import Data, Batch, DataLoader
+from torch_geometric.data import DataLoader
 from torch_geometric.utils import to_dense_batch
 
 from data import get_dataset
-from metric import LayoutFID, compute_maximum_iou, \
-    compute_overlap, compute_alignment
+from metric import LayoutFID, RunningMoments, compute_maximum_iou, \
+    compute_maximum_ious, get_cond2layouts, compute_overlap, compute_alignment
+from util import get_file_hash
+from layout_store import load_layouts
 
 
 def average(scores):
     return sum(scores) / len(scores)
 
 
+def get_reference_path(dataset_name, split, fid):
+    # the reference depends on the processed split and on LayoutNet, so
+    # both hashes are part of the file name and a change to either one
+    # makes eval.py build a new file
+    data_path = Path(f'data/dataset/{dataset_name}/processed/{split}.pt')
+    if not data_path.exists():
+        get_dataset(dataset_name, split)  # process the raw data first
+    key = get_file_hash(data_path)[:16] + get_file_hash(fid.model_path)[:16]
+    return Path('output/reference') / f'{dataset_name}_{split}_{key}.npz'
+
+
+def save_reference(path, mu, sigma, cond2layouts):
+    # layouts are stored group by group as flat arrays:
+    # layout k of the file is bbox[offsets[k]:offsets[k + 1]], and
+    # group g holds layouts groups[g]:groups[g + 1]
+    layouts = list(chain.from_iterable(cond2layouts.values()))
+    offsets = np.cumsum([0] + [len(l) for _, l in layouts])
+    groups = np.cumsum([0] + [len(v) for v in cond2layouts.values()])
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for old_path in path.parent.glob(path.name.rsplit('_', 1)[0] + '_*.npz'):
+        old_path.unlink()
+
+    tmp_path = path.with_suffix('.tmp.npz')
+    np.savez(tmp_path, mu=mu, sigma=sigma,
+             bbox=np.concatenate([b for b, _ in layouts]).astype(np.float32),
+             label=np.concatenate([l for _, l in layouts]).astype(np.int16),
+             offsets=offsets, groups=groups)
+    tmp_path.replace(path)
+
+
+def load_reference(path):
+    with np.load(path) as f:
+        mu, sigma = f['mu'], f['sigma']
+        bbox, label = f['bbox'], f['label'].astype(np.int64)
+        offsets, groups = f['offsets'], f['groups']
+
+    layouts = [(bbox[s:e], label[s:e])
+               for s, e in zip(offsets[:-1], offsets[1:])]
+    cond2layouts = get_cond2layouts([layouts[s] for s in groups[:-1]])
+    for key, s, e in zip(cond2layouts.keys(), groups[:-1], groups[1:]):
+        cond2layouts[key] = layouts[s:e]
+    return mu, sigma, cond2layouts
+
+
+def compute_reference(dataloader, fid, device):
+    layouts = []
+    for data in dataloader:
+        data = data.to(device)
+        label, mask = to_dense_batch(data.y, data.batch)
+        bbox, _ = to_dense_batch(data.x, data.batch)
+        padding_mask = ~mask
+
+        fid.collect_features(bbox, label, padding_mask, real=True)
+
+        for b, l, m in zip(bbox.cpu().numpy(), label.cpu().numpy(),
+                           mask.cpu().numpy()):
+            layouts.append((b[m], l[m]))
+
+    mu, sigma = fid.get_real_statistics()
+    return mu, sigma, get_cond2layouts(layouts)
+
+
+def iter_dense_batches(stores, batch_size):
+    # dense batches over the concatenation of several layout stores:
+    # index [B] of the store each layout comes from, bbox [B, N, 4],
+    # label [B, N], mask [B, N]
+    sizes = np.cumsum([0] + [len(store) for store in stores])
+    for i in range(0, sizes[-1], batch_size):
+        i_end = min(i + batch_size, sizes[-1])
+        parts = []
+        for k, store in enumerate(stores):
+            s = max(i, sizes[k]) - sizes[k]
+            e = min(i_end, sizes[k + 1]) - sizes[k]
+            if s < e:
+                parts.append((k, store, s, e))
+
+        max_len = max(store.lengths[s:e].max() for _, store, s, e in parts)
+        batches = [store.get_batch(s, e, max_len) for _, store, s, e in parts]
+        index = np.concatenate([np.full(e - s, k) for k, _, s, e in parts])
+        yield (index, *map(np.concatenate, zip(*batches)))
+
+
 def print_scores(score_dict):
     for k, v in score_dict.items():
         if k in ['Alignment', 'Overlap']:
@@ -28,55 +115,91 @@ def print_scores(score_dict):
             print(f'\t{k}: {v[0]:.2f}')
 
 
+def save_report_json(out_path, dataset_name, pkl_paths, score_dict):
+    report = {
+        'dataset': dataset_name,
+        'results': [
+            {'pkl_path': pkl_path,
+             **{k: v[i] for k, v in score_dict.items()}}
+            for i, pkl_path in enumerate(pkl_paths)
+        ],
+        'summary': {
+            k: {'mean': float(np.mean(v)), 'std': float(np.std(v))}
+            for k, v in score_dict.items()
+        },
+    }
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    with Path(out_path).open('w') as f:
+        json.dump(report, f, indent=2)
+
+
+def save_report_csv(out_path, pkl_paths, score_dict):
+    # one row per input file, followed by the mean and std rows
+    keys = list(score_dict.keys())
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    with Path(out_path).open('w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pkl_path'] + keys)
+        for i, pkl_path in enumerate(pkl_paths):
+            writer.writerow([pkl_path] + [score_dict[k][i] for k in keys])
+        writer.writerow(['mean'] + [np.mean(score_dict[k]) for k in keys])
+        writer.writerow(['std'] + [np.std(score_dict[k]) for k in keys])
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('dataset', type=str, help='dataset name',
                         choices=['rico', 'publaynet', 'magazine'])
     parser.add_argument('pkl_paths', type=str, nargs='+',
-                        help='generated pickle path')
+                        help='generated layouts path '
+                        '(layout store or pickle)')
     parser.add_argument('--batch_size', type=int,
                         default=64, help='input batch size')
     parser.add_argument('--compute_real', action='store_true')
+    parser.add_argument('--n_jobs', type=int, default=None,
+                        help='number of Max. IoU workers (default: all cores)')
+    parser.add_argument('--progress', action='store_true',
+                        help='show the progress of the Max. IoU computation')
+    parser.add_argument('--out_json', type=str, default=None,
+                        help='write the scores of every input as JSON')
+    parser.add_argument('--out_csv', type=str, default=None,
+                        help='write the scores of every input as CSV')
     args = parser.parse_args()
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    dataset = get_dataset(args.dataset, 'test')
-    dataloader = DataLoader(dataset,
-                            batch_size=args.batch_size,
-                            num_workers=4,
-                            pin_memory=True,
-                            shuffle=False)
-    test_layouts = [(data.x.numpy(), data.y.numpy()) for data in dataset]
+    def get_dataloader(split):
+        dataset = get_dataset(args.dataset, split)
+        return DataLoader(dataset,
+                          batch_size=args.batch_size,
+                          num_workers=4,
+                          pin_memory=True,
+                          shuffle=False)
 
     # prepare for evaluation
     fid_test = LayoutFID(args.dataset, device)
 
-    # real layouts
-    alignment, overlap = [], []
-    for i, data in enumerate(dataloader):
-        data = data.to(device)
-        label, mask = to_dense_batch(data.y, data.batch)
-        bbox, _ = to_dense_batch(data.x, data.batch)
-        padding_mask = ~mask
-
-        fid_test.collect_features(bbox, label, padding_mask,
-                                  real=True)
+    # real layouts: FID statistics and layouts of the test split are
+    # cached, see get_reference_path
+    ref_path = get_reference_path(args.dataset, 'test', fid_test)
+    if ref_path.exists():
+        mu, sigma, test_layouts = load_reference(ref_path)
+        fid_test.set_real_statistics(mu, sigma)
+    else:
+        mu, sigma, test_layouts = compute_reference(
+            get_dataloader('test'), fid_test, device)
+        save_reference(ref_path, mu, sigma, test_layouts)
 
-        if args.compute_real:
+    alignment, overlap = [], []
+    if args.compute_real:
+        for data in get_dataloader('test'):
+            data = data.to(device)
+            bbox, mask = to_dense_batch(data.x, data.batch)
             alignment += compute_alignment(bbox, mask).tolist()
             overlap += compute_overlap(bbox, mask).tolist()
 
-    if args.compute_real:
-        dataset = get_dataset(args.dataset, 'val')
-        dataloader = DataLoader(dataset,
-                                batch_size=args.batch_size,
-                                num_workers=4,
-                                pin_memory=True,
-                                shuffle=False)
-        val_layouts = [(data.x.numpy(), data.y.numpy()) for data in dataset]
-
-        for i, data in enumerate(dataloader):
+        val_layouts = []
+        for data in get_dataloader('val'):
             data = data.to(device)
             label, mask = to_dense_batch(data.y, data.batch)
             bbox, _ = to_dense_batch(data.x, data.batch)
@@ -84,6 +207,10 @@ def main():
 
             fid_test.collect_features(bbox, label, padding_mask)
 
+            for b, l, m in zip(bbox.cpu().numpy(), label.cpu().numpy(),
+                               mask.cpu().numpy()):
+                val_layouts.append((b[m], l[m]))
+
         fid_score = fid_test.compute_score()
         max_iou = compute_maximum_iou(test_layouts, val_layouts)
         alignment = average(alignment)
@@ -98,48 +225,52 @@ def main():
         })
         print()
 
-    # generated layouts
-    scores = defaultdict(list)
-    for pkl_path in args.pkl_paths:
-        alignment, overlap = [], []
-        with Path(pkl_path).open('rb') as fb:
-            generated_layouts = pickle.load(fb)
-
-        for i in range(0, len(generated_layouts), args.batch_size):
-            i_end = min(i + args.batch_size, len(generated_layouts))
-
-            # get batch from data list
-            data_list = []
-            for b, l in generated_layouts[i:i_end]:
-                bbox = torch.tensor(b, dtype=torch.float)
-                label = torch.tensor(l, dtype=torch.long)
-                data = Data(x=bbox, y=label)
-                data_list.append(data)
-            data = Batch.from_data_list(data_list)
+    # generated layouts: all files are opened up front, LayoutNet runs
+    # on batches mixed across them and Max. IoU of every file is
+    # scheduled on one worker pool
+    generated = [load_layouts(pkl_path) for pkl_path in args.pkl_paths]
 
-            data = data.to(device)
-            label, mask = to_dense_batch(data.y, data.batch)
-            bbox, _ = to_dense_batch(data.x, data.batch)
-            padding_mask = ~mask
+    fake_moments = [RunningMoments() for _ in generated]
+    alignment = [[] for _ in generated]
+    overlap = [[] for _ in generated]
+    for index, bbox, label, mask in iter_dense_batches(generated,
+                                                       args.batch_size):
+        index = torch.from_numpy(index).to(device)
+        bbox = torch.from_numpy(bbox).to(device)
+        label = torch.from_numpy(label).to(device)
+        mask = torch.from_numpy(mask).to(device)
+        padding_mask = ~mask
 
-            fid_test.collect_features(bbox, label, padding_mask)
-            alignment += compute_alignment(bbox, mask).tolist()
-            overlap += compute_overlap(bbox, mask).tolist()
+        feats = fid_test.extract_features(bbox, label, padding_mask)
+        _alignment = compute_alignment(bbox, mask)
+        _overlap = compute_overlap(bbox, mask)
+        for k in index.unique().tolist():
+            is_k = index == k
+            fake_moments[k].update(feats[is_k])
+            alignment[k] += _alignment[is_k].tolist()
+            overlap[k] += _overlap[is_k].tolist()
 
-        fid_score = fid_test.compute_score()
-        max_iou = compute_maximum_iou(test_layouts, generated_layouts)
-        alignment = average(alignment)
-        overlap = average(overlap)
+    max_ious = compute_maximum_ious(test_layouts, generated,
+                                    n_jobs=args.n_jobs,
+                                    progress=args.progress)
 
-        scores['FID'].append(fid_score)
-        scores['Max. IoU'].append(max_iou)
-        scores['Alignment'].append(alignment)
-        scores['Overlap'].append(overlap)
+    scores = defaultdict(list)
+    for k in range(len(generated)):
+        scores['FID'].append(fid_test.compute_score(fake_moments[k]))
+        scores['Max. IoU'].append(max_ious[k])
+        scores['Alignment'].append(average(alignment[k]))
+        scores['Overlap'].append(average(overlap[k]))
 
     print(f'Input size: {len(args.pkl_paths)}')
     print(f'Dataset: {args.dataset}')
     print_scores(scores)
 
+    if args.out_json:
+        save_report_json(args.out_json, args.dataset,
+                         args.pkl_paths, scores)
+    if args.out_csv:
+        save_report_csv(args.out_csv, args.pkl_paths, scores)
+
 
 if __name__ == "__main__":
     main()
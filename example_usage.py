@@ -7,9 +7,9 @@ def get_colors(num_classes):
     colors = sns.color_palette('husl', n_colors=n_colors)
     return [tuple(map(lambda x: int(x * 255), c)) for c in colors]
 
-(bbox, label) = generate_bbox_beautify('pretrained/layoutganpp_magazine.pth.tar', [0,0,1,1,2], 5)
+(bbox, label, latent) = generate_bbox_beautify('pretrained/layoutganpp_magazine.pth.tar', [0,0,1,1,2], 5)
 out_path = 'output/beautify/optimized_0.png'
 convert_layout_to_image(bbox, label, get_colors(5), (120, 80)).save(out_path)
-(bbox2, label2) = generate_bbox_relation('pretrained/layoutganpp_magazine.pth.tar', 4, 3, 'top', bbox, label, 5)
+(bbox2, label2, latent2) = generate_bbox_relation('pretrained/layoutganpp_magazine.pth.tar', [(4, 3, 'top'), (0, 1, 'top')], bbox, label, 5, latent=latent)
 out_path_2 = 'output/beautify/optimized_0_rel.png'
 convert_layout_to_image(bbox2, label2, get_colors(5), (120, 80)).save(out_path_2)
\ No newline at end of file
@@ -0,0 +1,33 @@
+import argparse
+from pathlib import Path
+
+import torch
+
+from util import export_weights, get_weights_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ckpt_path', type=str, help='checkpoint path')
+    parser.add_argument('-o', '--out_path', type=str, default=None,
+                        help='output path (default: <name>.weights next to '
+                             'the checkpoint)')
+    args = parser.parse_args()
+
+    out_path = args.out_path or get_weights_path(args.ckpt_path)
+    out_path = Path(out_path)
+    out_path.parent.mkdir(exist_ok=True, parents=True)
+
+    # optimizer states and training bookkeeping are dropped,
+    # only args, netG and netD are kept
+    ckpt = torch.load(args.ckpt_path, map_location='cpu')
+    export_weights(ckpt, out_path)
+
+    in_size = Path(args.ckpt_path).stat().st_size
+    out_size = out_path.stat().st_size
+    print(f'Exported weights are saved at: {out_path} '
+          f'({in_size / 2**20:.1f} MiB -> {out_size / 2**20:.1f} MiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,14 @@
-import pickle
 import argparse
+import numpy as np
 from pathlib import Path
 
 import torch
-from torch_geometric.data import DataLoader
-from torch_geometric.utils import to_dense_batch
 
-from util import set_seed, convert_layout_to_image
-from data import get_dataset
+from util import set_seed, convert_layouts_to_images, load_checkpoint
+from data import get_dataset, get_dense_dataset, get_dataloader, \
+    get_dense_batch
+from data.sampler import BucketBatchSampler, get_lengths
+from layout_store import LayoutWriter, save_layouts
 from model.layoutganpp import Generator
 
 
@@ -17,11 +18,20 @@ def main():
     parser.add_argument('--batch_size', type=int, default=64,
                         help='batch size')
     parser.add_argument('-o', '--out_path', type=str,
-                        default='output/generated_layouts.pkl',
-                        help='output pickle path')
+                        default='output/generated_layouts.layouts',
+                        help='output path, a layout store '
+                        '(or the old pickle list for *.pkl)')
     parser.add_argument('--num_save', type=int, default=0,
                         help='number of layouts to save as images')
     parser.add_argument('--seed', type=int, help='manual seed')
+    parser.add_argument('--dense_data', action='store_true',
+                        help='read the dataset from memory-mapped arrays '
+                        'and collate dense batches (see data/dense.py)')
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help='batch layouts with the same number of elements')
+    parser.add_argument('--max_tokens', type=int, default=None,
+                        help='elements per batch when bucketing by length '
+                        '(default: batch_size layouts per batch)')
     args = parser.parse_args()
 
     if args.seed is not None:
@@ -33,16 +43,25 @@ def main():
 
     # load checkpoint
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    ckpt = torch.load(args.ckpt_path, map_location=device)
+    ckpt = load_checkpoint(args.ckpt_path, device)
     train_args = ckpt['args']
 
     # load test dataset
-    dataset = get_dataset(train_args['dataset'], 'test')
-    dataloader = DataLoader(dataset,
-                            batch_size=args.batch_size,
-                            num_workers=4,
-                            pin_memory=True,
-                            shuffle=False)
+    load_dataset = get_dense_dataset if args.dense_data else get_dataset
+    dataset = load_dataset(train_args['dataset'], 'test')
+    if args.bucket_by_length:
+        sampler = BucketBatchSampler(get_lengths(dataset), args.batch_size,
+                                     max_tokens=args.max_tokens)
+        dataloader = get_dataloader(dataset,
+                                    batch_sampler=sampler,
+                                    num_workers=4,
+                                    pin_memory=True)
+    else:
+        dataloader = get_dataloader(dataset,
+                                    batch_size=args.batch_size,
+                                    num_workers=4,
+                                    pin_memory=True,
+                                    shuffle=False)
     num_label = dataset.num_classes
 
     # setup model and load state
@@ -53,32 +72,36 @@ def main():
                      ).eval().to(device)
     netG.load_state_dict(ckpt['netG'])
 
-    results = []
+    results = LayoutWriter()
     with torch.no_grad():
         for data in dataloader:
-            data = data.to(device)
-            label, mask = to_dense_batch(data.y, data.batch)
+            _, label, mask = get_dense_batch(data, device)
             padding_mask = ~mask
             z = torch.randn(label.size(0), label.size(1),
                             train_args['latent_size'], device=device)
 
             bbox = netG(z, label, padding_mask)
 
-            for j in range(bbox.size(0)):
-                mask_j = mask[j]
-                b = bbox[j][mask_j].cpu().numpy()
-                l = label[j][mask_j].cpu().numpy()
-
-                if len(results) < args.num_save:
-                    convert_layout_to_image(
-                        b, l, dataset.colors, (120, 80)
-                    ).save(out_dir / f'generated_{len(results)}.png')
-
-                results.append((b, l))
-
-    # save results
-    with out_path.open('wb') as fb:
-        pickle.dump(results, fb)
+            # rasterized together, on the device
+            num_save = min(bbox.size(0), args.num_save - len(results))
+            if num_save > 0:
+                images = convert_layouts_to_images(
+                    bbox[:num_save], label[:num_save], mask[:num_save],
+                    dataset.colors, (120, 80))
+                for j, image in enumerate(images):
+                    image.save(out_dir / f'generated_{len(results) + j}.png')
+
+            bbox, label, mask = bbox.cpu().numpy(), \
+                label.cpu().numpy(), mask.cpu().numpy()
+
+            results.append_batch(bbox, label, mask)
+
+    # save results, in the order of the dataset
+    results = results.to_store()
+    if args.bucket_by_length:
+        order = [i for batch in sampler for i in batch]
+        results = results.select(np.argsort(order))
+    save_layouts(out_path, results)
     print('Generated layouts are saved at:', args.out_path)
 
 
@@ -1,20 +1,25 @@
 import os
 os.environ['OMP_NUM_THREADS'] = '1'  # noqa
 
-import pickle
+import queue
+import random
 import argparse
-import tempfile
-import subprocess
+import traceback
+import numpy as np
 from tqdm import tqdm
 from pathlib import Path
 
 import torch
-import torchvision.transforms as T
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset
 from torch_geometric.data import DataLoader
 from torch_geometric.utils import to_dense_batch
 
 from data import get_dataset
-from util import set_seed, convert_layout_to_image
+from data.sampler import BucketBatchSampler, get_lengths
+from layout_store import LayoutWriter, save_layouts
+from util import set_seed, derive_seed, convert_layouts_to_images, \
+    load_checkpoint
 from data.util import AddCanvasElement, AddRelation
 from model.layoutganpp import Generator, Discriminator
 
@@ -24,92 +29,93 @@ from clg.optim import AdamOptimizer, CMAESOptimizer
 from metric import compute_violation, get_relations
 
 
-def save_gif(out_path, j, netG,
-             z_hist, label, mask, padding_mask,
-             dataset_colors, canvas_size):
-    mask = mask[j]
-    _j = slice(j, j + 1)
-
-    z_before, z_filtered = None, []
-    for z in z_hist:
-        if z_before is not None:
-            if z_before.eq(z[_j]).all():
-                continue
-        z_filtered.append(z)
-        z_before = z[_j]
-    z_filtered += [z] * 2
-
-    with tempfile.TemporaryDirectory() as tempdir:
-        for i, z in enumerate(z_filtered):
-            bbox = netG(z[_j], label[_j], padding_mask[_j])
-            b = bbox[0][mask].cpu().numpy()
-            l = label[0][mask].cpu().numpy()
-
-            convert_layout_to_image(
-                b, l, dataset_colors, canvas_size
-            ).save(tempdir + f'/{j}_{i:08d}.png')
-
-        subprocess.run(['convert', '-delay', '50',
-                        tempdir + f'/{j}_*.png', str(out_path)])
-
-
-def main():
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
-
-    parser.add_argument('ckpt_path', type=str, help='checkpoint path')
-    parser.add_argument('--batch_size', type=int, default=32,
-                        help='batch size')
-    parser.add_argument('-o', '--out_path', type=str,
-                        default='output/generated_layouts.pkl',
-                        help='output pickle path')
-    parser.add_argument('--num_save', type=int, default=0,
-                        help='number of layouts to save as images')
-    parser.add_argument('--seed', type=int, help='manual seed')
-
-    # CLG specific options
-    parser.add_argument('--const_type', type=str,
-                        default='beautify', help='constraint type',
-                        choices=['beautify', 'relation'])
-    parser.add_argument('--optimizer', type=str,
-                        default='CMAES', help='inner optimizer',
-                        choices=['Adam', 'CMAES'])
-    parser.add_argument('--rel_ratio', type=float, default=0.1,
-                        help='ratio of relational constraints')
-
-    args = parser.parse_args()
-
-    if args.seed is not None:
-        set_seed(args.seed)
-
-    out_path = Path(args.out_path)
-    out_dir = out_path.parent
-    out_dir.mkdir(exist_ok=True, parents=True)
-
-    # load checkpoint
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    ckpt = torch.load(args.ckpt_path, map_location=device)
+class TrajectoryRecorder():
+    # latents of the first num_save layouts of a batch at every step of
+    # the optimization. save_gifs() decodes them with netG, rasterizes
+    # the frames in memory and encodes the GIFs in process
+    def __init__(self, num_save):
+        self.num_save = max(num_save, 0)
+        self.z_hist = []
+
+    def append(self, z):
+        if self.num_save > 0:
+            self.z_hist.append(z[:self.num_save])
+
+    def save_gifs(self, out_paths, netG, label, mask,
+                  dataset_colors, canvas_size, duration=500, chunk_size=64):
+        # out_paths: one per recorded layout. frames are decoded and
+        # rasterized chunk_size at a time, and each GIF is written before
+        # the next layout is decoded
+        z = torch.stack(self.z_hist)  # [T, S, N, latent_size]
+        for j, out_path in enumerate(out_paths):
+            # frames of the steps that changed the latents of the layout
+            z_j = z[:, j]
+            keep = torch.ones(z_j.size(0), dtype=torch.bool, device=z.device)
+            keep[1:] = (z_j[1:] != z_j[:-1]).flatten(1).any(dim=1)
+
+            images = []
+            for z_chunk in z_j[keep].split(chunk_size):
+                label_j = label[j].expand(z_chunk.size(0), -1)
+                mask_j = mask[j].expand(z_chunk.size(0), -1)
+                with torch.no_grad():
+                    bbox = netG(z_chunk, label_j, ~mask_j)
+                images += convert_layouts_to_images(bbox, label_j, mask_j,
+                                                    dataset_colors,
+                                                    canvas_size)
+
+            # hold the last frame
+            images += [images[-1]] * 2
+            images[0].save(out_path, save_all=True,
+                           append_images=images[1:],
+                           duration=duration, loop=0)
+
+
+class RelationDataset(Dataset):
+    # adds relational constraints to the layouts of dataset. the
+    # relations of layout idx are sampled with a generator seeded by
+    # (seed, idx), so they do not depend on the shard or the data loader
+    # worker that loads the layout
+    def __init__(self, dataset, seed, ratio):
+        self.dataset = dataset
+        self.seed = seed
+        self.ratio = ratio
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        transform = AddRelation(derive_seed(self.seed, 0, idx), self.ratio)
+        return transform(self.dataset[idx])
+
+
+def run_shard(args, batches, batch_ids, device, put):
+    # runs CLG-LO on batches[b] for b in batch_ids and calls
+    # put(b, bbox, label, mask, violation) for each. the noise of batch b
+    # is drawn from a generator seeded by (seed, b), so the layouts do
+    # not depend on which process runs the batch
+    device = torch.device(device)
+    ckpt = load_checkpoint(args.ckpt_path, device)
     train_args = ckpt['args']
 
     # setup transforms and constraints
-    transforms = [AddCanvasElement()]
+    dataset = get_dataset(train_args['dataset'], 'test', AddCanvasElement())
     if args.const_type == 'relation':
-        transforms += [AddRelation(args.seed, args.rel_ratio)]
+        test_dataset = RelationDataset(dataset, args.seed, args.rel_ratio)
         constraints = clg.const.relation
     else:
+        test_dataset = dataset
         constraints = clg.const.beautify
 
-    # load test dataset
-    dataset = get_dataset(train_args['dataset'], 'test',
-                          T.Compose(transforms))
+    # the shards share the 4 data loader workers of a single process,
+    # at least one each so that loading overlaps with the optimization
+    dataloader = DataLoader(test_dataset,
+                            batch_sampler=[batches[b] for b in batch_ids],
+                            num_workers=max(1, 4 // args.num_shards),
+                            pin_memory=True)
+
+    # index of the first layout of every batch in the results
+    starts = np.cumsum([0] + [len(batch) for batch in batches]).tolist()
 
-    dataloader = DataLoader(dataset,
-                            batch_size=args.batch_size,
-                            num_workers=4,
-                            pin_memory=True,
-                            shuffle=False)
-    
     num_label = dataset.num_classes
 
     # setup model and load state
@@ -134,26 +140,28 @@ def main():
         inner_optimizer = AdamOptimizer()
     optimizer = AugLagMethod(netG, netD, inner_optimizer, constraints)
 
-    results, violation = [], []
+    out_dir = Path(args.out_path).parent
 
-    for data in tqdm(dataloader, ncols=100):
+    for b, data in zip(batch_ids, dataloader):
         data = data.to(device)
         label_c, mask_c = to_dense_batch(data.y, data.batch)
         label = torch.relu(label_c[:, 1:] - 1)
         mask = mask_c[:, 1:]
         padding_mask = ~mask
 
+        generator = torch.Generator().manual_seed(derive_seed(args.seed, 1, b))
         z = torch.randn(label.size(0), label.size(1),
                         train_args['latent_size'],
-                        device=device)
+                        generator=generator).to(device)
 
-        z_hist = [z]
+        recorder = TrajectoryRecorder(args.num_save - starts[b])
+        recorder.append(z)
         for z in optimizer.generator(z, data):
-            if len(results) < args.num_save:
-                z_hist.append(z)
+            recorder.append(z)
 
         bbox = netG(z, label, padding_mask)
 
+        violation = []
         if args.const_type == 'relation':
             canvas = optimizer.bbox_canvas.to(bbox)
             canvas = canvas.expand(bbox.size(0), -1, -1)
@@ -161,43 +169,166 @@ def main():
             v = compute_violation(bbox_flatten, data)
             # relations = get_relations(bbox_flatten, data)
             # print('\nRELATIONS: ', relations)
-            violation += v[~v.isnan()].tolist()
+            violation = v[~v.isnan()].tolist()
+
+        num_save = min(bbox.size(0), args.num_save - starts[b])
+        if num_save > 0:
+            bbox_init = netG(recorder.z_hist[0], label[:num_save],
+                             padding_mask[:num_save])
+            images_init = convert_layouts_to_images(
+                bbox_init, label[:num_save], mask[:num_save],
+                dataset.colors, (120, 80))
+            images = convert_layouts_to_images(
+                bbox[:num_save], label[:num_save], mask[:num_save],
+                dataset.colors, (120, 80))
+
+            ids = range(starts[b], starts[b] + num_save)
+            for i, image_init, image in zip(ids, images_init, images):
+                image_init.save(out_dir / f'initial_{i}.png')
+                image.save(out_dir / f'optimized_{i}.png')
+
+            recorder.save_gifs([out_dir / f'optimizing_{i}.gif' for i in ids],
+                               netG, label, mask, dataset.colors, (120, 80))
+
+        put(b, bbox.cpu().numpy(), label.cpu().numpy(), mask.cpu().numpy(),
+            violation)
+
+
+def _run_worker(args, batches, batch_ids, device, results):
+    try:
+        run_shard(args, batches, batch_ids, device,
+                  lambda *result: results.put(result))
+    except BaseException:
+        results.put(('error', traceback.format_exc()))
+
+
+def run_sharded(args, batches, put):
+    # every num_shards-th batch goes to the same worker process; the
+    # results are passed to put() in the order they arrive
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    processes = []
+    for shard in range(args.num_shards):
+        if torch.cuda.is_available():
+            device = f'cuda:{shard % torch.cuda.device_count()}'
+        else:
+            device = 'cpu'
+        batch_ids = list(range(shard, len(batches), args.num_shards))
+        process = ctx.Process(target=_run_worker,
+                              args=(args, batches, batch_ids, device,
+                                    results))
+        process.start()
+        processes.append(process)
+
+    try:
+        for _ in range(len(batches)):
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    for process in processes:
+                        if process.exitcode not in (None, 0):
+                            raise RuntimeError(
+                                'generation worker exited with code '
+                                f'{process.exitcode}')
+            if result[0] == 'error':
+                raise RuntimeError(f'generation worker failed:\n{result[1]}')
+            put(*result)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
 
-        if len(results) < args.num_save:
-            bbox_init = netG(z_hist[0], label, padding_mask)
 
-        for j in range(bbox.size(0)):
-            mask_j = mask[j]
-            b = bbox[j][mask_j].cpu().numpy()
-            l = label[j][mask_j].cpu().numpy()
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
 
+    parser.add_argument('ckpt_path', type=str, help='checkpoint path')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('-o', '--out_path', type=str,
+                        default='output/generated_layouts.layouts',
+                        help='output path, a layout store '
+                        '(or the old pickle list for *.pkl)')
+    parser.add_argument('--num_save', type=int, default=0,
+                        help='number of layouts to save as images')
+    parser.add_argument('--seed', type=int, help='manual seed')
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help='batch layouts with the same number of elements')
+    parser.add_argument('--max_tokens', type=int, default=None,
+                        help='elements per batch when bucketing by length '
+                        '(default: batch_size layouts per batch)')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='number of worker processes; the layouts are '
+                        'the same for any number')
 
-            if len(results) < args.num_save:
-                out_path = out_dir / f'initial_{len(results)}.png'
-                convert_layout_to_image(
-                    bbox_init[j][mask_j].cpu().numpy(),
-                    l, dataset.colors, (120, 80)
-                ).save(out_path)
+    # CLG specific options
+    parser.add_argument('--const_type', type=str,
+                        default='beautify', help='constraint type',
+                        choices=['beautify', 'relation'])
+    parser.add_argument('--optimizer', type=str,
+                        default='CMAES', help='inner optimizer',
+                        choices=['Adam', 'CMAES'])
+    parser.add_argument('--rel_ratio', type=float, default=0.1,
+                        help='ratio of relational constraints')
 
-                out_path = out_dir / f'optimized_{len(results)}.png'
-                convert_layout_to_image(
-                    b, l, dataset.colors, (120, 80)
-                ).save(out_path)
+    args = parser.parse_args()
 
-                out_path = out_dir / f'optimizing_{len(results)}.gif'
-                save_gif(out_path, j, netG,
-                         z_hist, label, mask, padding_mask,
-                         dataset.colors, (120, 80))
+    # every batch and relation is seeded from args.seed
+    if args.seed is None:
+        args.seed = random.randint(0, 10000)
+    set_seed(args.seed)
 
-            results.append((b, l))
+    out_path = Path(args.out_path)
+    out_dir = out_path.parent
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    # split the test dataset into batches
+    ckpt = load_checkpoint(args.ckpt_path, 'cpu')
+    dataset = get_dataset(ckpt['args']['dataset'], 'test')
+    del ckpt
+    if args.bucket_by_length:
+        sampler = BucketBatchSampler(get_lengths(dataset), args.batch_size,
+                                     max_tokens=args.max_tokens)
+        batches = sampler.get_batches()
+    else:
+        indices = list(range(len(dataset)))
+        batches = [indices[i:i + args.batch_size]
+                   for i in range(0, len(indices), args.batch_size)]
+
+    outputs = {}
+    with tqdm(total=len(batches), ncols=100) as pbar:
+        def put(b, *output):
+            outputs[b] = output
+            pbar.update()
+
+        if args.num_shards > 1:
+            run_sharded(args, batches, put)
+        else:
+            device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+            run_shard(args, batches, range(len(batches)), device, put)
+
+    # merge the results and violations in the order of the batches
+    results, violation = LayoutWriter(), []
+    for b in range(len(batches)):
+        bbox, label, mask, v = outputs.pop(b)
+        results.append_batch(bbox, label, mask)
+        violation += v
 
     if args.const_type == 'relation':
         violation = sum(violation) / len(violation)
         print(f'Relation violation: {violation:.2%}')
 
-    # save results
-    with Path(args.out_path).open('wb') as fb:
-        pickle.dump(results, fb)
+    # save results, in the order of the dataset
+    results = results.to_store()
+    if args.bucket_by_length:
+        order = [i for batch in batches for i in batch]
+        results = results.select(np.argsort(order))
+    save_layouts(args.out_path, results)
     print('Generated layouts are saved at:', args.out_path)
 
 
@@ -1,36 +1,78 @@
 import os
 os.environ['OMP_NUM_THREADS'] = '1'  # noqa
 
-import pickle
-import argparse
-import tempfile
-import subprocess
-from tqdm import tqdm
-from pathlib import Path
-import seaborn as sns
-
 import torch
-import torchvision.transforms as T
-
-from torch_geometric.data import DataLoader, InMemoryDataset, Data
-from torch_geometric.utils import to_dense_batch
+from torch_geometric.data import Data
 
-from data import get_dataset
-from util import set_seed, convert_layout_to_image
-from data.util import AddCanvasElement, AddRelation, AddCustomRelation
+# only what the serving path needs is imported here: this module is
+# loaded by every API worker (see main.py and import_profile.py)
+from util import load_checkpoint, assign_state_dict
+from data.util import AddCanvasElement, AddCustomRelation
 from model.layoutganpp import Generator, Discriminator
 
 import clg.const
 from clg.auglag import AugLagMethod
-from clg.optim import AdamOptimizer, CMAESOptimizer
-from metric import compute_violation, get_relations
+from clg.optim import CMAESOptimizer
+from clg.inversion import LatentInversion
+
+
+# (ckpt_path, num_label, device) -> (train_args, netG, netD)
+_models = {}
+
+
+def load_model(ckpt_path, num_label, device, ckpt=None):
+    # models are built once per process and reused by every request;
+    # exported weight files stay memory-mapped instead of being copied.
+    # ckpt: the checkpoint of ckpt_path if the caller already loaded it
+    key = (ckpt_path, num_label, device)
+    if key in _models:
+        return _models[key]
+
+    if ckpt is None:
+        ckpt = load_checkpoint(ckpt_path, device)
+    train_args = ckpt['args']
+
+    netG = Generator(train_args['latent_size'], num_label,
+                     d_model=train_args['G_d_model'],
+                     nhead=train_args['G_nhead'],
+                     num_layers=train_args['G_num_layers'],
+                     ).eval().requires_grad_(False).to(device)
+    assign_state_dict(netG, ckpt['netG'])
+
+    netD = Discriminator(num_label,
+                         d_model=train_args['D_d_model'],
+                         nhead=train_args['D_nhead'],
+                         num_layers=train_args['D_num_layers'],
+                         ).eval().requires_grad_(False).to(device)
+    assign_state_dict(netD, ckpt['netD'])
+
+    _models[key] = train_args, netG, netD
+    return _models[key]
 
 
-def generate_bbox_beautify(ckpt_path, label, num_label):
+def preload_model(ckpt_path):
+    # warm the load_model() cache before gunicorn forks its workers; the
+    # number of labels is read off the generator's label embedding
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if device.type == 'cuda':
+        # CUDA contexts do not survive a fork, workers load lazily instead
+        return None
+    ckpt = load_checkpoint(ckpt_path, device)
+    num_label = ckpt['netG']['emb_label.weight'].size(0)
+    return load_model(ckpt_path, num_label, device, ckpt)
+
+
+def get_latent_size(ckpt_path, num_label):
+    # width of a latent row, for checking latents sent by clients
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    train_args, netG, netD = load_model(ckpt_path, num_label, device)
+    return train_args['latent_size']
+
+
+def generate_bbox_beautify(ckpt_path, label, num_label, seed=None):
     # load checkpoint
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    ckpt = torch.load(ckpt_path, map_location=device)
-    train_args = ckpt['args']
+    train_args, netG, netD = load_model(ckpt_path, num_label, device)
 
     # set up transforms and constraints
     transforms = [AddCanvasElement()]
@@ -56,32 +98,20 @@ def generate_bbox_beautify(ckpt_path, label, num_label):
 
     data = data.to(device)
 
-    # setup model and load state
-    netG = Generator(train_args['latent_size'], num_label,
-                     d_model=train_args['G_d_model'],
-                     nhead=train_args['G_nhead'],
-                     num_layers=train_args['G_num_layers'],
-                     ).eval().requires_grad_(False).to(device)
-    netG.load_state_dict(ckpt['netG'])
-
-    netD = Discriminator(num_label,
-                         d_model=train_args['D_d_model'],
-                         nhead=train_args['D_nhead'],
-                         num_layers=train_args['D_num_layers'],
-                         ).eval().requires_grad_(False).to(device)
-    netD.load_state_dict(ckpt['netD'])
-
     # setup optimizers
-    inner_optimizer = CMAESOptimizer()
+    inner_optimizer = CMAESOptimizer(seed=seed)
     optimizer = AugLagMethod(netG, netD, inner_optimizer, constraints)
 
     label = label[None, :].to(device) # expand label dims
 
     results, violation = [], []
 
+    generator = None
+    if seed is not None:
+        generator = torch.Generator(device).manual_seed(seed)
     z = torch.randn(label.size(0), label.size(1),
                     train_args['latent_size'],
-                    device=device)
+                    generator=generator, device=device)
     z_hist = [z]
     for z in optimizer.generator(z, data):
         if len(results) < 1:
@@ -91,16 +121,21 @@ def generate_bbox_beautify(ckpt_path, label, num_label):
     mask_j = mask[0]
     b = bbox[0][mask_j].cpu().numpy()
     l = label[0][mask_j].cpu().numpy()
-    return (b, l)
-
-def generate_bbox_relation(ckpt_path, id_a, id_b, relation, bbox, label, num_label):
+    z = z[0][mask_j].cpu().numpy()
+    return (b, l, z)
+
+def generate_bbox_relation(ckpt_path, relations, bbox, label, num_label, seed=None, incremental=False, latent=None):
+    # relations: list of (id_a, id_b, relation), optimized jointly in one run
+    # incremental: start from the latents of the current layout and only
+    #   optimize the boxes named in relations, the rest stay close to bbox
+    # latent: latents of the current layout (e.g. from invert_layouts), used
+    #   as the starting point instead of random noise
     # load checkpoint
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    ckpt = torch.load(ckpt_path, map_location=device)
-    train_args = ckpt['args']
+    train_args, netG, netD = load_model(ckpt_path, num_label, device)
 
     # set up transforms and constraints
-    transforms = [AddCanvasElement(), AddCustomRelation(id_a, id_b, relation)] 
+    transforms = [AddCanvasElement(), AddCustomRelation(relations)] 
     constraints = clg.const.relation
 
     label = torch.tensor(label)
@@ -123,34 +158,40 @@ def generate_bbox_relation(ckpt_path, id_a, id_b, relation, bbox, label, num_lab
 
     data = data.to(device)
 
-    # setup model and load state
-    netG = Generator(train_args['latent_size'], num_label,
-                     d_model=train_args['G_d_model'],
-                     nhead=train_args['G_nhead'],
-                     num_layers=train_args['G_num_layers'],
-                     ).eval().requires_grad_(False).to(device)
-    netG.load_state_dict(ckpt['netG'])
-
-    netD = Discriminator(num_label,
-                         d_model=train_args['D_d_model'],
-                         nhead=train_args['D_nhead'],
-                         num_layers=train_args['D_num_layers'],
-                         ).eval().requires_grad_(False).to(device)
-    netD.load_state_dict(ckpt['netD'])
-
     # setup optimizers
-    inner_optimizer = CMAESOptimizer()
+    inner_optimizer = CMAESOptimizer(seed=seed)
     optimizer = AugLagMethod(netG, netD, inner_optimizer, constraints)
 
     label = label[None, :].to(device) # expand label dims
 
     results, violation = [], []
 
+    generator = None
+    if seed is not None:
+        generator = torch.Generator(device).manual_seed(seed)
     z = torch.randn(label.size(0), label.size(1),
                     train_args['latent_size'],
-                    device=device)
+                    generator=generator, device=device)
+
+    if latent is not None:
+        z = torch.tensor(latent, dtype=torch.float)[None, :].to(device)
+
+    latent_mask, bbox_ref = None, None
+    if incremental:
+        bbox_ref = x[None, :].to(device)
+        if latent is None:
+            z, _ = LatentInversion(netG).invert(bbox_ref, label, padding_mask)
+        latent_mask = torch.zeros_like(mask)
+        for id_a, id_b, _ in relations:
+            for i in (id_a, id_b):
+                if i > 0:  # 0 is the canvas
+                    latent_mask[0, i - 1] = True
+        if not latent_mask.any():
+            # no box is named in the relations, keep the layout as it is
+            return (x.numpy(), label[0].cpu().numpy(), z[0].cpu().numpy())
+
     z_hist = [z]
-    for z in optimizer.generator(z, data):
+    for z in optimizer.generator(z, data, latent_mask, bbox_ref):
         if len(results) < 1:
             z_hist.append(z)
 
@@ -158,4 +199,29 @@ def generate_bbox_relation(ckpt_path, id_a, id_b, relation, bbox, label, num_lab
     mask_j = mask[0]
     b = bbox[0][mask_j].cpu().numpy()
     l = label[0][mask_j].cpu().numpy()
-    return (b, l)
\ No newline at end of file
+    z = z[0][mask_j].cpu().numpy()
+    return (b, l, z)
+
+
+def invert_layouts(ckpt_path, layouts, num_label, tolerance=1e-4, num_restarts=2):
+    # layouts: list of (bbox, label), inverted together in one batch
+    # returns a list of (latent, reconstruction error) per layout
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    train_args, netG, netD = load_model(ckpt_path, num_label, device)
+
+    N = max(len(l) for _, l in layouts)
+    bbox = torch.zeros(len(layouts), N, 4)
+    label = torch.zeros(len(layouts), N, dtype=torch.long)
+    mask = torch.zeros(len(layouts), N, dtype=torch.bool)
+    for i, (b, l) in enumerate(layouts):
+        bbox[i, :len(l)] = torch.tensor(b, dtype=torch.float)
+        label[i, :len(l)] = torch.tensor(l, dtype=torch.long)
+        mask[i, :len(l)] = True
+    bbox, label, mask = bbox.to(device), label.to(device), mask.to(device)
+
+    inversion = LatentInversion(netG, tolerance=tolerance,
+                                num_restarts=num_restarts, seed=0)
+    z, err = inversion.invert(bbox, label, ~mask)
+
+    return [(z[i][mask[i]].cpu().numpy(), err[i].item())
+            for i in range(len(layouts))]
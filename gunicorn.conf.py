@@ -0,0 +1,71 @@
+import gc
+import os
+
+# Serving config for start.sh. With PRELOAD=1 (default) the app and the
+# model weights are loaded once in the master and workers are forked from
+# it, so they share the torch/model pages copy-on-write.
+
+workers = int(os.environ.get('WORKERS', 2))
+timeout = int(os.environ.get('TIMEOUT', 300))
+bind = '0.0.0.0:8000'
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = os.environ.get('PRELOAD', '1') == '1'
+
+
+def get_available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_memory_usage():
+    # sizes in KiB from /proc/self/smaps_rollup (Linux only)
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, *value = line.split()
+                if len(value) == 2 and value[1] == 'kB':
+                    usage[key.rstrip(':')] = int(value[0])
+    except OSError:
+        pass
+    return usage
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+
+    # runs in the master after the app is imported and before any fork
+    from main import PRETRAINED_PTH
+    from generate_custom_const import preload_model
+    preload_model(PRETRAINED_PTH)
+
+    # keep the GC from writing to (and so un-sharing) the preloaded objects
+    gc.freeze()
+
+    rss = get_memory_usage().get('Rss', 0)
+    server.log.info('Preloaded %s in master (RSS %.1f MiB)',
+                    PRETRAINED_PTH, rss / 1024)
+
+
+def post_fork(server, worker):
+    import torch
+    threads = max(1, get_available_cores() // server.num_workers)
+    torch.set_num_threads(threads)
+    server.log.info('Worker %s uses %d intra-op threads',
+                    worker.pid, threads)
+
+
+def post_worker_init(worker):
+    # Rss counts pages shared with the master, Pss splits them between
+    # the processes mapping them: the difference is what sharing saves
+    usage = get_memory_usage()
+    if not usage:
+        return
+    rss, pss = usage.get('Rss', 0), usage.get('Pss', 0)
+    shared = usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0)
+    worker.log.info('Worker %s memory: RSS %.1f MiB, shared %.1f MiB, '
+                    'saved %.1f MiB', worker.pid, rss / 1024,
+                    shared / 1024, (rss - pss) / 1024)
@@ -0,0 +1,75 @@
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+# training and evaluation dependencies that the serving path must only
+# import on first use
+LAZY_MODULES = ['seaborn', 'torchvision', 'pytorch_fid', 'scipy', 'cma',
+                'matplotlib', 'pycocotools']
+
+
+def profile_import(module, cwd=None):
+    # returns the total import time and the cumulative time of every
+    # module, both in seconds, as reported by `python -X importtime`
+    proc = subprocess.run([sys.executable, '-X', 'importtime',
+                           '-c', f'import {module}'],
+                          cwd=cwd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            depth = (len(name) - len(name.lstrip())) // 2
+            times.append((name.strip(), int(cumulative) / 1e6, depth))
+
+    total = sum(t for _, t, depth in times if depth == 0)
+    return total, times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Profile the cold import of a serving entry point and '
+                    'fail if it exceeds a time budget.'
+    )
+    parser.add_argument('module', type=str, nargs='?', default='main',
+                        help='module to import (e.g. main, or util with '
+                             '--cwd kafka_app)')
+    parser.add_argument('--cwd', type=str, default=None,
+                        help='directory to import the module from')
+    parser.add_argument('--budget', type=float, default=4.3,
+                        help='maximum allowed import time in seconds')
+    parser.add_argument('--top', type=int, default=15,
+                        help='number of slowest top-level imports to show')
+    args = parser.parse_args()
+
+    cwd = Path(args.cwd) if args.cwd else Path(__file__).parent
+    total, times = profile_import(args.module, cwd)
+
+    slowest = sorted([(t, n) for n, t, depth in times if depth <= 1],
+                     reverse=True)[:args.top]
+    print(f'Import time of `{args.module}`: {total:.2f}s '
+          f'(budget {args.budget:.2f}s)')
+    for t, name in slowest:
+        print(f'\t{t:7.3f}s  {name}')
+
+    failed = False
+    imported = {name.split('.')[0] for name, _, _ in times}
+    eager = [m for m in LAZY_MODULES if m in imported]
+    if eager:
+        print('Imported modules that should load lazily: '
+              + ', '.join(eager))
+        failed = True
+    if total > args.budget:
+        print(f'Import time exceeds the budget by {total - args.budget:.2f}s')
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
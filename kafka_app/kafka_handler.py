@@ -2,7 +2,6 @@ import os
 import json
 import bisect
 import requests
-from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 from PIL import Image
 from io import BytesIO
@@ -111,7 +110,7 @@ async def handle_infographic_generation(event_stream):
                     label.append(k)
         print('Getting infographic layout...')
         try:
-            gen_bbox, gen_label = get_generation_from_api(NUM_LABEL, label)
+            gen_bbox, gen_label, gen_latent = get_generation_from_api(NUM_LABEL, label, return_latent=True)
         except Exception as e:
             await handle_error(
                 event.request_id,
@@ -128,11 +127,15 @@ async def handle_infographic_generation(event_stream):
                 largest_area = area
                 largest_area_idx = i
         gen_bbox[graph_idx], gen_bbox[largest_area_idx] = gen_bbox[largest_area_idx], gen_bbox[graph_idx]
+        if graph_idx != largest_area_idx:
+            # latents no longer match the swapped boxes, the first edit recovers them
+            gen_latent = None
         print(gen_label, gen_bbox)
         # stores information relevant to this infographic layout
         layout_dict = event_to_dict(event)
         layout_dict['bbox'] = gen_bbox
         layout_dict['label'] = gen_label
+        layout_dict['latent'] = gen_latent
         layout_dict['present_sections'] = present_sections
         infographic_img = convert_layout_to_infographic(input_dict, gen_bbox, gen_label, (CANVAS_HEIGHT, CANVAS_WIDTH))
 
@@ -232,7 +235,7 @@ async def handle_delete_instruction(event_stream):
         # get new layout
         print('Getting infographic layout...')
         try:
-            gen_bbox, gen_label = get_generation_from_api(NUM_LABEL, label)
+            gen_bbox, gen_label, gen_latent = get_generation_from_api(NUM_LABEL, label, return_latent=True)
         except Exception as e:
             await handle_error(
                 event.request_id,
@@ -246,6 +249,7 @@ async def handle_delete_instruction(event_stream):
         layout_dict['label'] = label
         layout_dict['present_sections'] = present_sections
         layout_dict['bbox'] = gen_bbox
+        layout_dict['latent'] = gen_latent
 
         # save image data to stream
         img_bytes = BytesIO()
@@ -346,7 +350,7 @@ async def handle_add_instruction(event_stream):
         # get new layout
         print('Getting infographic layout..')
         try:
-            gen_bbox, gen_label = get_generation_from_api(NUM_LABEL, label)
+            gen_bbox, gen_label, gen_latent = get_generation_from_api(NUM_LABEL, label, return_latent=True)
         except Exception as e:
             await handle_error(
                 event.request_id,
@@ -360,6 +364,7 @@ async def handle_add_instruction(event_stream):
         layout_dict['label'] = label
         layout_dict['present_sections'] = present_sections
         layout_dict['bbox'] = gen_bbox
+        layout_dict['latent'] = gen_latent
 
         # save image data to stream
         img_bytes = BytesIO()
@@ -452,7 +457,7 @@ async def handle_move_instruction(event_stream):
         # get edited layout
         print('Getting infographic layout..')
         try:
-            gen_bbox, gen_label = get_edit_from_api(reference_id, target_id, direction, curr_bbox, NUM_LABEL, curr_label)
+            gen_bbox, gen_label, gen_latent = get_edit_from_api(reference_id, target_id, direction, curr_bbox, NUM_LABEL, curr_label, latent=layout_dict.get('latent'), incremental=True, return_latent=True)
         except Exception as e:
             await handle_error(
                 event.request_id,
@@ -464,6 +469,7 @@ async def handle_move_instruction(event_stream):
         infographic_img = convert_layout_to_infographic(input_dict, gen_bbox, gen_label, (CANVAS_HEIGHT, CANVAS_WIDTH))
         # update layout dict
         layout_dict['bbox'] = gen_bbox
+        layout_dict['latent'] = gen_latent
 
         # save image data to stream
         img_bytes = BytesIO()
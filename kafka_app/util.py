@@ -1,12 +1,8 @@
-import networkx as nx
 import requests
-import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw, ImageFont
 import json
 import os
 from dotenv import load_dotenv
-import boto3
-from botocore.exceptions import ClientError
 import logging
 import numpy as np
 
@@ -49,6 +45,10 @@ def convert_keys_str_to_int(d):
     return new_d
 
 def convert_graph_to_image(adj_list, node_occurrences, entity_labels):
+    # networkx and matplotlib are slow to import, load them on first use
+    import networkx as nx
+    import matplotlib.pyplot as plt
+
     # create the graph
     DG = nx.DiGraph()
     # add nodes
@@ -102,16 +102,25 @@ def resize_pil_image(img, width, height):
     return canvas
 
 # Querying infographic generator endpoint
-def get_generation_from_api(num_label, label):
+def get_generation_from_api(num_label, label, return_latent=False):
     headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
     res = requests.post(url=generation_endpoint + '/generate', data=json.dumps({'num_label': num_label, 'label': label}), headers=headers, timeout=100)
     bboxes, labels = res.json()['results']['bbox'], res.json()['results']['label']
+    if return_latent:
+        return bboxes, labels, res.json()['results'].get('latent')
     return bboxes, labels
 
-def get_edit_from_api(id_a, id_b, relation, bbox, num_label, label):
+def get_edit_from_api(id_a, id_b, relation, bbox, num_label, label, latent=None, incremental=False, return_latent=False):
+    '''
+    latent: generator latents stored with the layout, the edit starts from
+    them instead of from noise; without them, an incremental edit recovers
+    them from bbox first
+    '''
     headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-    res = requests.post(url=generation_endpoint + '/edit', data=json.dumps({'id_a': id_a, 'id_b': id_b, 'relation': relation, 'bbox': bbox, 'num_label': num_label, 'label': label}), headers=headers, timeout=100)
+    res = requests.post(url=generation_endpoint + '/edit', data=json.dumps({'id_a': id_a, 'id_b': id_b, 'relation': relation, 'bbox': bbox, 'num_label': num_label, 'label': label, 'latent': latent, 'incremental': incremental}), headers=headers, timeout=100)
     bboxes, labels = res.json()['results']['bbox'], res.json()['results']['label']
+    if return_latent:
+        return bboxes, labels, res.json()['results'].get('latent')
     return bboxes, labels
 
 def draw_text_on_canvas(text, color, background_color, canvas_size):
@@ -226,6 +235,9 @@ def upload_fileobj(file_object, bucket, object_name):
     :return: True if file was uploaded, else False
     """
 
+    import boto3
+    from botocore.exceptions import ClientError
+
     # Upload the file
     s3_client = boto3.client(
         's3',
@@ -248,6 +260,9 @@ def download_fileobj(bucket, object_name, file_object):
     :param object_name S3 object name
     :return True if file was succesfully downloaded, else False
     """
+    import boto3
+    from botocore.exceptions import ClientError
+
     s3_client = boto3.client(
         's3',
         aws_access_key_id=aws_access_key_id,
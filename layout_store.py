@@ -0,0 +1,192 @@
+import json
+import pickle
+import numpy as np
+from pathlib import Path
+
+LAYOUTS_MAGIC = b'LGPPLAY1'
+LAYOUTS_ALIGN = 64
+
+
+def is_layout_store(path):
+    with Path(path).open('rb') as f:
+        return f.read(len(LAYOUTS_MAGIC)) == LAYOUTS_MAGIC
+
+
+class LayoutStore():
+    # columnar storage of variable-length layouts: the boxes of layout i
+    # are bbox[offsets[i]:offsets[i + 1]] ([x, y, w, h], float32) and
+    # their labels label[offsets[i]:offsets[i + 1]] (int32).
+    # a stored file is memory-mapped, so opening it reads only the header
+    def __init__(self, bbox, label, offsets):
+        self.bbox = bbox
+        self.label = label
+        self.offsets = offsets
+
+    @classmethod
+    def from_layouts(cls, layouts):
+        # layouts: list of (bbox, label) tuples, the old pickle format
+        offsets = np.zeros(len(layouts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(l) for _, l in layouts])
+        if len(layouts) > 0:
+            bbox = np.concatenate([b for b, _ in layouts])
+            label = np.concatenate([l for _, l in layouts])
+        else:
+            bbox, label = np.zeros((0, 4)), np.zeros(0)
+        return cls(bbox.astype(np.float32).reshape(-1, 4),
+                   label.astype(np.int32), offsets)
+
+    @classmethod
+    def open(cls, path):
+        with Path(path).open('rb') as f:
+            if f.read(len(LAYOUTS_MAGIC)) != LAYOUTS_MAGIC:
+                raise ValueError(f'{path} is not a layout store')
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size).decode('utf-8'))
+        data_start = len(LAYOUTS_MAGIC) + 8 + size
+        data_start = -(-data_start // LAYOUTS_ALIGN) * LAYOUTS_ALIGN
+
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+        arrays = {}
+        for name, meta in header['arrays'].items():
+            dtype = np.dtype(meta['dtype'])
+            begin = data_start + meta['offset']
+            end = begin + int(np.prod(meta['shape'])) * dtype.itemsize
+            arrays[name] = buf[begin:end].view(dtype).reshape(meta['shape'])
+        return cls(arrays['bbox'], arrays['label'], arrays['offsets'])
+
+    def save(self, path):
+        # magic, header size, JSON header (dtype/shape/offset per array),
+        # then the aligned raw arrays, as in util.export_weights
+        arrays = {
+            'offsets': np.ascontiguousarray(self.offsets, dtype=np.int64),
+            'bbox': np.ascontiguousarray(self.bbox, dtype=np.float32),
+            'label': np.ascontiguousarray(self.label, dtype=np.int32),
+        }
+        meta, offset = {}, 0
+        for name, a in arrays.items():
+            offset = -(-offset // LAYOUTS_ALIGN) * LAYOUTS_ALIGN
+            meta[name] = {'dtype': str(a.dtype), 'shape': list(a.shape),
+                          'offset': offset}
+            offset += a.nbytes
+
+        header = json.dumps({'arrays': meta}).encode('utf-8')
+        data_start = len(LAYOUTS_MAGIC) + 8 + len(header)
+        data_start = -(-data_start // LAYOUTS_ALIGN) * LAYOUTS_ALIGN
+
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            f.write(LAYOUTS_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for name, a in arrays.items():
+                f.seek(data_start + meta[name]['offset'])
+                f.write(a.tobytes())
+        tmp_path.replace(path)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        s, e = self.offsets[i], self.offsets[i + 1]
+        return self.bbox[s:e], self.label[s:e]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, indices):
+        # new in-memory store with the layouts at indices, in that order
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        # position of every selected box in the source arrays
+        src = np.repeat(self.offsets[indices] - offsets[:-1], lengths) \
+            + np.arange(offsets[-1])
+        return LayoutStore(self.bbox[src], self.label[src], offsets)
+
+    def gather(self, indices, max_len=None):
+        # dense arrays of the layouts at indices, as get_batch()
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        if max_len is None:
+            max_len = lengths.max() if len(lengths) > 0 else 0
+        mask = np.arange(max_len)[None, :] < lengths[:, None]
+        src = (self.offsets[indices][:, None] + np.arange(max_len))[mask]
+
+        bbox = np.zeros((len(lengths), max_len, 4), dtype=np.float32)
+        label = np.zeros((len(lengths), max_len), dtype=np.int64)
+        bbox[mask] = self.bbox[src]
+        label[mask] = self.label[src]
+        return bbox, label, mask
+
+    def get_batch(self, start, end, max_len=None):
+        # dense arrays of layouts start..end-1, zero padded:
+        # bbox [B, N, 4], label [B, N], mask [B, N]
+        lengths = self.lengths[start:end]
+        if max_len is None:
+            max_len = lengths.max() if len(lengths) > 0 else 0
+        mask = np.arange(max_len)[None, :] < lengths[:, None]
+
+        s, e = self.offsets[start], self.offsets[end]
+        bbox = np.zeros((len(lengths), max_len, 4), dtype=np.float32)
+        label = np.zeros((len(lengths), max_len), dtype=np.int64)
+        bbox[mask] = self.bbox[s:e]
+        label[mask] = self.label[s:e]
+        return bbox, label, mask
+
+
+class LayoutWriter():
+    # collects dense generator outputs and writes them as one LayoutStore
+    def __init__(self):
+        self.bbox, self.label, self.lengths = [], [], []
+
+    def __len__(self):
+        return sum(len(l) for l in self.lengths)
+
+    def append_batch(self, bbox, label, mask):
+        # bbox: [B, N, 4]  label: [B, N]  mask: [B, N], numpy arrays
+        self.bbox.append(bbox[mask].astype(np.float32))
+        self.label.append(label[mask].astype(np.int32))
+        self.lengths.append(mask.sum(axis=1))
+
+    def append(self, bbox, label):
+        self.bbox.append(np.asarray(bbox, dtype=np.float32).reshape(-1, 4))
+        self.label.append(np.asarray(label, dtype=np.int32))
+        self.lengths.append(np.asarray([len(label)]))
+
+    def to_store(self):
+        lengths = np.concatenate(self.lengths or [np.zeros(0)])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        bbox = np.concatenate(self.bbox or [np.zeros((0, 4), np.float32)])
+        label = np.concatenate(self.label or [np.zeros(0, np.int32)])
+        return LayoutStore(bbox, label, offsets)
+
+    def save(self, path):
+        self.to_store().save(path)
+
+
+def load_layouts(path):
+    # generated layouts from either a layout store or an old pickle
+    if is_layout_store(path):
+        return LayoutStore.open(path)
+
+    with Path(path).open('rb') as fb:
+        return LayoutStore.from_layouts(pickle.load(fb))
+
+
+def save_layouts(path, store):
+    # .pkl keeps writing the old list of (bbox, label) tuples for
+    # existing consumers, any other suffix a layout store
+    if Path(path).suffix == '.pkl':
+        with Path(path).open('wb') as fb:
+            pickle.dump([(np.array(b), np.array(l, dtype=np.int64))
+                         for b, l in store], fb)
+    else:
+        store.save(path)
@@ -1,7 +1,4 @@
 import os
-import sys
-import traceback
-from joblib import load
 
 import uvicorn
 from fastapi import FastAPI, Request, status
@@ -12,13 +9,20 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
-import torch
-
 from schema import *
-from generate_custom_const import *
+from generate_custom_const import generate_bbox_beautify, generate_bbox_relation, invert_layouts, get_latent_size
+from util import get_weights_path
+from data.util import AddCustomRelation
+from cache import get_result_cache, get_checkpoint_id
 from exception_handler import validation_exception_handler, python_exception_handler
 
 PRETRAINED_PTH = 'pretrained/layoutganpp_magazine.pth.tar'
+# prefer the stripped, memory-mapped weights written by export_model.py
+if get_weights_path(PRETRAINED_PTH).exists():
+    PRETRAINED_PTH = str(get_weights_path(PRETRAINED_PTH))
+
+# only requests with a seed are deterministic and therefore cached
+result_cache = get_result_cache()
 
 app = FastAPI(
     title='Infographic Generator',
@@ -43,14 +47,21 @@ def do_generate(request: Request, body: GenerateInput):
     # generate given some input labels
     logger.info('generate API called')
 
-    (bbox, label) = generate_bbox_beautify(PRETRAINED_PTH, body.label, body.num_label)
+    def generate():
+        (bbox, label, latent) = generate_bbox_beautify(PRETRAINED_PTH, body.label, body.num_label, body.seed)
+        return {
+            'bbox': bbox.tolist(),
+            'label': label.tolist(),
+            'latent': latent.tolist()
+        }
 
-    logger.info('boxes successfully generated')
+    if body.seed is None or result_cache is None:
+        results = generate()
+    else:
+        key = result_cache.make_key(endpoint='generate', ckpt=get_checkpoint_id(PRETRAINED_PTH), **body.dict())
+        results = result_cache.get_or_compute(key, generate)
 
-    results = {
-        'bbox': bbox,
-        'label': label
-    }
+    logger.info('boxes successfully generated')
 
     return {
         'error': False,
@@ -62,18 +73,81 @@ def do_generate(request: Request, body: GenerateInput):
     responses={422: {'model': ErrorResponse}, 500: {'model': ErrorResponse}}
     )
 def do_edit(request: Request, body: EditInput):
-    # generate given some input labels
-    logger.info('generate API called')
-
-    (bbox, label) = generate_bbox_relation(PRETRAINED_PTH, body.id_a, body.id_b, body.relation, body.bbox, body.label, body.num_label)
+    # edit given one or more relations, all of them are optimized jointly
+    logger.info('edit API called')
+
+    relations = body.get_relations()
+    message = None
+    if len(relations) == 0:
+        message = 'no relation given'
+    for (id_a, id_b, relation) in relations:
+        if id_a is None or id_b is None:
+            message = 'id_a and id_b are required for a relation'
+        elif not (0 <= id_a <= len(body.label) and 0 < id_b <= len(body.label)) or id_a == id_b:
+            message = f'invalid box IDs for relation: ({id_a}, {id_b})'
+        elif not AddCustomRelation.is_valid_relation(relation):
+            message = f'unknown relation: {relation}'
+    if message is None and AddCustomRelation.find_conflict(relations) is not None:
+        (id_a, id_b, relation) = AddCustomRelation.find_conflict(relations)
+        message = f'conflicting relation for boxes ({id_a}, {id_b}): {relation}'
+    if body.latent is not None and len(body.latent) != len(body.label):
+        message = 'latent must have one row per box'
+    elif body.latent is not None:
+        latent_size = get_latent_size(PRETRAINED_PTH, body.num_label)
+        if any(len(row) != latent_size for row in body.latent):
+            message = f'each latent row must have {latent_size} values'
+    if message is not None:
+        return JSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content={'error': True, 'message': message}
+        )
+
+    def generate():
+        (bbox, label, latent) = generate_bbox_relation(PRETRAINED_PTH, relations, body.bbox, body.label, body.num_label, body.seed, body.incremental, body.latent)
+        return {
+            'bbox': bbox.tolist(),
+            'label': label.tolist(),
+            'latent': latent.tolist()
+        }
+
+    if body.seed is None or result_cache is None:
+        results = generate()
+    else:
+        key = result_cache.make_key(endpoint='edit', ckpt=get_checkpoint_id(PRETRAINED_PTH), **body.dict())
+        results = result_cache.get_or_compute(key, generate)
 
     logger.info('boxes successfully generated')
 
-    results = {
-        'bbox': bbox,
-        'label': label
+    return {
+        'error': False,
+        'results': results
     }
 
+@app.post('/invert',
+    response_model=InvertResponse,
+    responses={422: {'model': ErrorResponse}, 500: {'model': ErrorResponse}}
+    )
+def do_invert(request: Request, body: InvertInput):
+    # recover generator latents of existing layouts, to warm-start later edits
+    logger.info('invert API called')
+
+    if len(body.layouts) == 0 or any(len(layout.label) == 0 or len(layout.bbox) != len(layout.label) for layout in body.layouts):
+        return JSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content={'error': True, 'message': 'each layout needs one bbox per label'}
+        )
+
+    layouts = [(layout.bbox, layout.label) for layout in body.layouts]
+    inverted = invert_layouts(PRETRAINED_PTH, layouts, body.num_label, body.tolerance)
+
+    logger.info('latents successfully recovered')
+
+    results = [{
+        'latent': latent.tolist(),
+        'reconstruction_error': err,
+        'converged': err <= body.tolerance
+    } for latent, err in inverted]
+
     return {
         'error': False,
         'results': results
@@ -1,17 +1,70 @@
 import numpy as np
-import multiprocessing as mp
-from itertools import chain
-from scipy.optimize import linear_sum_assignment
+from itertools import chain, permutations
 
 import torch
 from torch_geometric.utils import to_dense_adj
-from pytorch_fid.fid_score import calculate_frechet_distance
 
 from model.layoutnet import LayoutNet
-from util import convert_xywh_to_ltrb
+from util import convert_xywh_to_ltrb, all_gather_object
 from data.util import RelSize, RelLoc, detect_size_relation, detect_loc_relation
 
 
+class RunningMoments():
+    # mean and covariance of a stream of feature batches, kept on device
+    # and merged batch by batch (Chan et al.'s parallel variance update)
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, feats):
+        # feats: [B, D]
+        feats = feats.detach().double()
+        n_b = feats.size(0)
+        if n_b == 0:
+            return
+
+        mean_b = feats.mean(dim=0)
+        diff = feats - mean_b
+        self.merge(n_b, mean_b, diff.t() @ diff)
+
+    def merge(self, n_b, mean_b, m2_b):
+        # add the moments of another set of features
+        if n_b == 0:
+            return
+
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n_b, mean_b, m2_b
+            return
+
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * (n_b / n)
+        self.m2 = self.m2 + m2_b + torch.outer(delta, delta) * (self.n * n_b / n)
+        self.n = n
+
+    def all_reduce(self):
+        # merge the moments of all processes of torch.distributed
+        device = self.mean.device if self.n > 0 else None
+        local = (self.n, None, None) if self.n == 0 else \
+            (self.n, self.mean.cpu(), self.m2.cpu())
+        gathered = all_gather_object(local)
+        self.reset()
+        for n_b, mean_b, m2_b in gathered:
+            if n_b > 0:
+                self.merge(n_b, mean_b.to(device or mean_b.device),
+                           m2_b.to(device or m2_b.device))
+
+    def compute(self):
+        # same as np.mean(feats, axis=0), np.cov(feats, rowvar=False)
+        mu = self.mean.cpu().numpy()
+        sigma = (self.m2 / (self.n - 1)).cpu().numpy()
+        return mu, sigma
+
+
 class LayoutFID():
     def __init__(self, dataset_name, device='cpu'):
         if dataset_name == 'rico':
@@ -23,37 +76,57 @@ class LayoutFID():
         self.model = LayoutNet(num_label).to(device)
 
         # load pre-trained LayoutNet
-        tmpl = './pretrained/layoutnet_{}.pth.tar'
-        state_dict = torch.load(tmpl.format(dataset_name), map_location=device)
+        self.model_path = f'./pretrained/layoutnet_{dataset_name}.pth.tar'
+        state_dict = torch.load(self.model_path, map_location=device)
         self.model.load_state_dict(state_dict)
         self.model.requires_grad_(False)
         self.model.eval()
 
-        self.real_features = []
-        self.fake_features = []
+        self.real_moments = RunningMoments()
+        self.fake_moments = RunningMoments()
+        # real statistics are fixed after the first compute_score()
+        # or set_real_statistics()
+        self.real_stats = None
+
+    def extract_features(self, bbox, label, padding_mask):
+        return self.model.extract_features(bbox.detach(), label, padding_mask)
 
     def collect_features(self, bbox, label, padding_mask, real=False):
-        if real and type(self.real_features) != list:
+        if real and self.real_stats is not None:
             return
 
-        feats = self.model.extract_features(bbox.detach(), label, padding_mask)
-        features = self.real_features if real else self.fake_features
-        features.append(feats.cpu().numpy())
+        feats = self.extract_features(bbox, label, padding_mask)
+        moments = self.real_moments if real else self.fake_moments
+        moments.update(feats)
 
-    def compute_score(self):
-        feats_1 = np.concatenate(self.fake_features)
-        self.fake_features = []
+    def all_reduce(self):
+        # with torch.distributed, every process collects the features of
+        # its own shard; call this on all of them before compute_score()
+        self.fake_moments.all_reduce()
+        if self.real_stats is None:
+            self.real_moments.all_reduce()
 
-        if type(self.real_features) == list:
-            feats_2 = np.concatenate(self.real_features)
-            self.real_features = feats_2
-        else:
-            feats_2 = self.real_features
+    def get_real_statistics(self):
+        if self.real_stats is None:
+            self.real_stats = self.real_moments.compute()
+            self.real_moments.reset()
+        return self.real_stats
 
-        mu_1 = np.mean(feats_1, axis=0)
-        sigma_1 = np.cov(feats_1, rowvar=False)
-        mu_2 = np.mean(feats_2, axis=0)
-        sigma_2 = np.cov(feats_2, rowvar=False)
+    def set_real_statistics(self, mu, sigma):
+        self.real_stats = (mu, sigma)
+        self.real_moments.reset()
+
+    def compute_score(self, fake_moments=None):
+        # fake_moments: features collected outside of this object, e.g.
+        # one RunningMoments per set of generated layouts
+        from pytorch_fid.fid_score import calculate_frechet_distance
+
+        if fake_moments is None:
+            fake_moments = self.fake_moments
+        mu_1, sigma_1 = fake_moments.compute()
+        fake_moments.reset()
+
+        mu_2, sigma_2 = self.get_real_statistics()
 
         return calculate_frechet_distance(mu_1, sigma_1, mu_2, sigma_2)
 
@@ -87,36 +160,81 @@ def compute_iou(box_1, box_2):
     return iou
 
 
-def __compute_maximum_iou_for_layout(layout_1, layout_2):
-    score = 0.
-    (bi, li), (bj, lj) = layout_1, layout_2
-    N = len(bi)
-    for l in list(set(li.tolist())):
-        _bi = bi[np.where(li == l)]
-        _bj = bj[np.where(lj == l)]
-        n = len(_bi)
-        ii, jj = np.meshgrid(range(n), range(n))
-        ii, jj = ii.flatten(), jj.flatten()
-        iou = compute_iou(_bi[ii], _bj[jj]).reshape(n, n)
-        ii, jj = linear_sum_assignment(iou, maximize=True)
-        score += iou[ii, jj].sum().item()
-    return score / N
-
-
-def __compute_maximum_iou(layouts_1_and_2):
-    layouts_1, layouts_2 = layouts_1_and_2
-    N, M = len(layouts_1), len(layouts_2)
-    ii, jj = np.meshgrid(range(N), range(M))
-    ii, jj = ii.flatten(), jj.flatten()
-    scores = np.asarray([
-        __compute_maximum_iou_for_layout(layouts_1[i], layouts_2[j])
-        for i, j in zip(ii, jj)
-    ]).reshape(N, M)
+# label blocks up to this size are matched by enumerating permutations,
+# larger ones fall back to scipy's linear_sum_assignment per pair
+EXACT_ASSIGNMENT_MAX_SIZE = 5
+# number of float64 values materialized per chunk of layout pairs
+CHUNK_NUM_VALUES = 2 ** 24
+
+
+def __stack_layouts(layouts):
+    # all layouts of a condition group have the same multiset of labels,
+    # so after sorting boxes by label the label blocks line up: [N, n, 4]
+    bboxes = [b[np.argsort(l, kind='stable')] for b, l in layouts]
+    return np.stack(bboxes).astype(np.float64)
+
+
+def __compute_block_assignment(iou):
+    # iou: [..., c, c], returns the maximum total IoU of a one-to-one
+    # matching for every leading index: [...]
+    c = iou.shape[-1]
+    if c == 1:
+        return iou[..., 0, 0]
+
+    if c <= EXACT_ASSIGNMENT_MAX_SIZE:
+        perms = np.asarray(list(permutations(range(c))))
+        return iou[..., np.arange(c), perms].sum(-1).max(-1)
+
+    from scipy.optimize import linear_sum_assignment
+    flat = iou.reshape(-1, c, c)
+    score = np.empty(len(flat))
+    for k, _iou in enumerate(flat):
+        ii, jj = linear_sum_assignment(_iou, maximize=True)
+        score[k] = _iou[ii, jj].sum()
+    return score.reshape(iou.shape[:-2])
+
+
+def __compute_maximum_iou_scores(bboxes_1, bboxes_2, labels):
+    # bboxes_1: [N, n, 4]  bboxes_2: [M, n, 4] sorted by label, see
+    # __stack_layouts; labels: [n] sorted labels of the condition group
+    # scores[i, j]: maximum IoU between layout i and layout j, i.e. the
+    # mean IoU of the best label-preserving box matching
+    (N, n, _), M = bboxes_1.shape, len(bboxes_2)
+
+    scores = np.zeros((N, M))
+    for l in np.unique(labels):
+        idx = np.where(labels == l)[0]
+        b1, b2 = bboxes_1[:, idx], bboxes_2[:, idx]
+        c = len(idx)
+
+        # values per pair of layouts in the largest intermediate
+        size = c * c * (len(list(permutations(range(c))))
+                        if 1 < c <= EXACT_ASSIGNMENT_MAX_SIZE else 1)
+        chunk = max(1, CHUNK_NUM_VALUES // (M * size))
+        for i in range(0, N, chunk):
+            # compute_iou works on the last axis through .T, so the
+            # broadcast pairs come out with reversed axes: [c, c, M, N']
+            iou = compute_iou(b1[i:i + chunk, None, :, None],
+                              b2[None, :, None, :]).T
+            scores[i:i + chunk] += __compute_block_assignment(iou)
+
+    return scores / n
+
+
+def __compute_maximum_iou(bboxes_1, bboxes_2, labels):
+    from scipy.optimize import linear_sum_assignment
+
+    scores = __compute_maximum_iou_scores(bboxes_1, bboxes_2, labels)
     ii, jj = linear_sum_assignment(scores, maximize=True)
     return scores[ii, jj]
 
 
-def __get_cond2layouts(layout_list):
+def get_cond2layouts(layout_list):
+    # layouts grouped by their sorted labels, the unit Max. IoU compares;
+    # an already grouped dict is returned as is
+    if isinstance(layout_list, dict):
+        return layout_list
+
     out = dict()
     for bs, ls in layout_list:
         cond_key = str(sorted(ls.tolist()))
@@ -127,17 +245,133 @@ def __get_cond2layouts(layout_list):
     return out
 
 
-def compute_maximum_iou(layouts_1, layouts_2, n_jobs=None):
-    c2bl_1 = __get_cond2layouts(layouts_1)
-    keys_1 = set(c2bl_1.keys())
-    c2bl_2 = __get_cond2layouts(layouts_2)
-    keys_2 = set(c2bl_2.keys())
-    keys = list(keys_1.intersection(keys_2))
-    args = [(c2bl_1[key], c2bl_2[key]) for key in keys]
-    with mp.Pool(n_jobs) as p:
-        scores = p.map(__compute_maximum_iou, args)
-    scores = np.asarray(list(chain.from_iterable(scores)))
-    return scores.mean().item()
+# persistent worker pool for compute_maximum_iou, created on first use
+_pool, _pool_size = None, None
+# shared memory blocks attached in a worker process, by name
+_worker_shm = {}
+
+
+def __get_pool(n_jobs):
+    import atexit
+    import multiprocessing as mp
+    global _pool, _pool_size
+
+    if _pool is not None and _pool_size != n_jobs:
+        _pool.terminate()
+        _pool = None
+
+    if _pool is None:
+        _pool, _pool_size = mp.Pool(n_jobs), n_jobs
+        atexit.register(_pool.terminate)
+
+    return _pool
+
+
+def __attach_shared_array(name, size):
+    from multiprocessing import shared_memory
+
+    if name not in _worker_shm:
+        # only one block is in use at a time, drop the previous ones;
+        # the parent unlinks them
+        for shm in _worker_shm.values():
+            shm.close()
+        _worker_shm.clear()
+        _worker_shm[name] = shared_memory.SharedMemory(name=name)
+
+    return np.ndarray((size,), dtype=np.float64,
+                      buffer=_worker_shm[name].buf)
+
+
+def __compute_maximum_iou_task(task):
+    # task: (index, name of the shared block, its size,
+    #        (offset, shape) of bboxes_1, (offset, shape) of bboxes_2,
+    #        labels)
+    index, name, size, (o1, shape1), (o2, shape2), labels = task
+    buf = __attach_shared_array(name, size)
+    bboxes_1 = buf[o1:o1 + int(np.prod(shape1))].reshape(shape1)
+    bboxes_2 = buf[o2:o2 + int(np.prod(shape2))].reshape(shape2)
+    return index, __compute_maximum_iou(bboxes_1, bboxes_2, labels)
+
+
+def compute_maximum_iou(layouts_1, layouts_2, n_jobs=None, progress=False):
+    return compute_maximum_ious(layouts_1, [layouts_2], n_jobs, progress)[0]
+
+
+def compute_maximum_ious(layouts_1, layouts_2_list, n_jobs=None,
+                         progress=False):
+    # Max. IoU of layouts_1 against each entry of layouts_2_list.
+    # condition groups of all entries are computed by a persistent pool of
+    # n_jobs workers; the stacked boxes are written to one shared memory
+    # block (layouts_1 once per group) and the largest groups are
+    # scheduled first
+    c2bl_1 = get_cond2layouts(layouts_1)
+
+    stacked_1, groups, size = {}, [], 0
+    for k, layouts_2 in enumerate(layouts_2_list):
+        c2bl_2 = get_cond2layouts(layouts_2)
+        for key in sorted(set(c2bl_1.keys()) & set(c2bl_2.keys())):
+            if key not in stacked_1:
+                stacked_1[key] = __stack_layouts(c2bl_1[key])
+                size += stacked_1[key].size
+            bboxes_2 = __stack_layouts(c2bl_2[key])
+            labels = np.sort(c2bl_1[key][0][1], kind='stable')
+            groups.append((k, key, bboxes_2, labels))
+            size += bboxes_2.size
+
+    # cost of a group ~ number of layout pairs x number of boxes
+    order = sorted(range(len(groups)), reverse=True,
+                   key=lambda i: len(stacked_1[groups[i][1]])
+                   * len(groups[i][2]) * len(groups[i][3]))
+
+    if n_jobs == 1 or len(groups) <= 1:
+        results = ((i, __compute_maximum_iou(stacked_1[groups[i][1]],
+                                             groups[i][2], groups[i][3]))
+                   for i in order)
+        shm = None
+    else:
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(size, 1) * 8)
+        buf = np.ndarray((size,), dtype=np.float64, buffer=shm.buf)
+
+        def write(bboxes):
+            nonlocal offset
+            buf[offset:offset + bboxes.size] = bboxes.ravel()
+            offset += bboxes.size
+            return offset - bboxes.size, bboxes.shape
+
+        offset = 0
+        offsets_1 = {key: write(b) for key, b in stacked_1.items()}
+        tasks = [(i, shm.name, size, offsets_1[key], write(bboxes_2),
+                  labels) for i, (_, key, bboxes_2, labels)
+                 in enumerate(groups)]
+        tasks = [tasks[i] for i in order]
+
+        pool = __get_pool(n_jobs)
+        results = pool.imap_unordered(__compute_maximum_iou_task, tasks)
+
+    if progress:
+        from tqdm import tqdm
+        results = tqdm(results, total=len(groups), ncols=100,
+                       desc='Max. IoU')
+
+    try:
+        scores = [[] for _ in layouts_2_list]
+        for i, score in results:
+            scores[groups[i][0]].append((i, score))
+    finally:
+        if shm is not None:
+            del buf
+            shm.close()
+            shm.unlink()
+
+    out = []
+    for _scores in scores:
+        _scores = [score for _, score in sorted(_scores, key=lambda x: x[0])]
+        _scores = np.asarray(list(chain.from_iterable(_scores)))
+        out.append(_scores.mean().item())
+    return out
 
 
 def compute_overlap(bbox, mask):
@@ -5,24 +5,61 @@ class GenerateInput(BaseModel):
     # input values for model generation of bbox
     label: List[int] = Field(..., example=[0,1,2], title='labels to be in the layout')
     num_label: int = Field(..., example=3, title='number of labels available for the layout')
+    seed: Optional[int] = Field(None, example=0, title='random seed, makes the result reproducible and cacheable')
 
-class EditInput(BaseModel):
-    # values to edit existing bbox layout based on relational constraints
-    id_a: int = Field(..., example=2, title='first box ID')
+class RelationInput(BaseModel):
+    # box id_b has relation over box id_a, id_a = 0 refers to the canvas (e.g. at top)
+    id_a: int = Field(..., example=2, title='first box ID, 0 for the canvas')
     id_b: int = Field(..., example=1, title='second box ID')
     relation: str = Field(..., example='equal', title='type of relation between boxes')
+
+class EditInput(BaseModel):
+    # values to edit existing bbox layout based on relational constraints
+    id_a: Optional[int] = Field(None, example=2, title='first box ID')
+    id_b: Optional[int] = Field(None, example=1, title='second box ID')
+    relation: Optional[str] = Field(None, example='equal', title='type of relation between boxes')
+    relations: List[RelationInput] = Field([], example=[{'id_a': 0, 'id_b': 1, 'relation': 'top'}], title='relations solved jointly, in addition to id_a/id_b/relation')
+    incremental: bool = Field(False, example=False, title='only move the boxes named in the relations, keep the others in place')
+    latent: Optional[List[List[float]]] = Field(None, example=[[0.1, -0.3, 0.8, 0.2]], title='latents of the current layout, used as the starting point')
     bbox: List[List[float]] = Field(..., example=[[0.5, 0.5, 0.25, 0.25]], title='current layout')
     label: List[int] = Field(..., example=[0,1,2], title='labels to be in the layout')
     num_label: int = Field(..., example=3, title='number of labels available for the layout')
+    seed: Optional[int] = Field(None, example=0, title='random seed, makes the result reproducible and cacheable')
+
+    def get_relations(self):
+        relations = [(r.id_a, r.id_b, r.relation) for r in self.relations]
+        if self.relation is not None:
+            relations.insert(0, (self.id_a, self.id_b, self.relation))
+        return relations
+
+class LayoutInput(BaseModel):
+    bbox: List[List[float]] = Field(..., example=[[0.5, 0.5, 0.25, 0.25]], title='bbox of layout')
+    label: List[int] = Field(..., example=[0], title='labels of the layout')
+
+class InvertInput(BaseModel):
+    # layouts to map back to generator latents
+    layouts: List[LayoutInput] = Field(..., title='layouts to invert')
+    num_label: int = Field(..., example=3, title='number of labels available for the layout')
+    tolerance: float = Field(1e-4, example=1e-4, title='mean squared box error at which a layout counts as reconstructed')
 
 class ModelResult(BaseModel):
     bbox: List[List[float]] = Field(..., example=[[0.5, 0.5, 0.25, 0.25]], title='bbox of layout')
     label: List[int] = Field(..., example=[0,1,2], title='labels of the layout')
+    latent: Optional[List[List[float]]] = Field(None, example=[[0.1, -0.3, 0.8, 0.2]], title='generator latents of the layout')
 
 class ModelResponse(BaseModel):
     error: bool = Field(..., example=False, title='whether there is error')
     results: ModelResult = ...
 
+class InvertResult(BaseModel):
+    latent: List[List[float]] = Field(..., example=[[0.1, -0.3, 0.8, 0.2]], title='generator latents of the layout')
+    reconstruction_error: float = Field(..., example=1e-5, title='mean squared box error of the reconstruction')
+    converged: bool = Field(..., example=True, title='whether the error is within tolerance')
+
+class InvertResponse(BaseModel):
+    error: bool = Field(..., example=False, title='whether there is error')
+    results: List[InvertResult] = ...
+
 class ErrorResponse(BaseModel):
     error: bool = Field(..., example=True, title='whether there is error')
     message: str = Field(..., example='', title='error message')
\ No newline at end of file
@@ -1,6 +1,3 @@
 #!/bin/bash
-gunicorn -w ${WORKERS:=2} \
-  -t ${TIMEOUT:=300} \
-  -b 0.0.0.0:8000 \
-  -k uvicorn.workers.UvicornWorker \
-  main:app
+# WORKERS, TIMEOUT and PRELOAD are read by gunicorn.conf.py
+exec gunicorn -c gunicorn.conf.py main:app
@@ -1,20 +1,44 @@
 import os
+import time
 import argparse
+from pathlib import Path
+from contextlib import nullcontext
 os.environ['OMP_NUM_THREADS'] = '1'  # noqa
 
 import torch
 import torch.optim as optim
+import torch.distributed as dist
 import torch.nn.functional as F
-import torchvision.transforms as T
-from torch_geometric.data import DataLoader
-from torch_geometric.utils import to_dense_batch
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 
-from data import get_dataset
-from metric import LayoutFID, compute_maximum_iou
+from data import get_dataset, get_dense_dataset, get_dataloader, \
+    get_dense_batch
+from data.sampler import BucketBatchSampler, get_lengths
+from metric import LayoutFID
+from validation import ValidationWorker
 from model.layoutganpp import Generator, Discriminator
-from data.util import LexicographicSort, HorizontalFlip
-from util import init_experiment, save_image, save_checkpoint
+from data.util import BatchLexicographicSort, BatchHorizontalFlip
+from util import init_experiment, set_seed, save_image, CheckpointWriter, \
+    get_rng_state, set_rng_state, init_distributed, all_gather_object
+
+
+def no_sync(model):
+    # skip the gradient all-reduce of a DistributedDataParallel module
+    # (possibly compiled) for one backward
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return nullcontext()
+
+
+def get_autocast(device, dtype):
+    # torch.autocast (PyTorch 1.10 or later) also covers bfloat16 and CPU;
+    # older versions only have the float16 autocast for CUDA
+    if hasattr(torch, 'autocast'):
+        return lambda: torch.autocast(device.type, dtype=dtype)
+    return torch.cuda.amp.autocast
 
 
 def main():
@@ -32,6 +56,25 @@ def main():
     parser.add_argument('--iteration', type=int, default=int(2e+5),
                         help='number of iterations to train for')
     parser.add_argument('--seed', type=int, help='manual seed')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='checkpoint to resume training from')
+    parser.add_argument('--dist_backend', type=str, default='gloo',
+                        help='torch.distributed backend, used when started '
+                        'with torchrun')
+    parser.add_argument('--val_device', type=str, default=None,
+                        help='device of the validation worker '
+                        '(default: the training device)')
+    parser.add_argument('--save_interval', type=int, default=5000,
+                        help='minimum number of iterations between '
+                        'checkpoints that are not written for validation')
+    parser.add_argument('--dense_data', action='store_true',
+                        help='read the dataset from memory-mapped arrays '
+                        'and collate dense batches (see data/dense.py)')
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help='batch layouts with the same number of elements')
+    parser.add_argument('--max_tokens', type=int, default=None,
+                        help='elements per batch when bucketing by length '
+                        '(default: batch_size layouts per batch)')
 
     # General
     parser.add_argument('--latent_size', type=int, default=4,
@@ -40,6 +83,14 @@ def main():
                         help='learning rate')
     parser.add_argument('--aug_flip', action='store_true',
                         help='use horizontal flip for data augmentation.')
+    parser.add_argument('--amp', nargs='?', const='fp16', default=None,
+                        choices=['fp16', 'bf16'],
+                        help='use mixed precision training; fp16 (CUDA '
+                        'only) uses gradient scaling, bf16 needs PyTorch '
+                        '1.10 or later')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the generator and discriminator '
+                        '(needs torch.compile)')
 
     # Generator
     parser.add_argument('--G_d_model', type=int, default=256,
@@ -58,31 +109,83 @@ def main():
                         help='num_layers for discriminator')
 
     args = parser.parse_args()
-    print(args)
 
-    out_dir = init_experiment(args, "LayoutGAN++")
-    writer = SummaryWriter(out_dir)
+    if args.compile and not hasattr(torch, 'compile'):
+        parser.error('--compile needs torch.compile (PyTorch 2.0 or later)')
+    if args.amp == 'bf16' and not hasattr(torch, 'autocast'):
+        parser.error('--amp bf16 needs torch.autocast (PyTorch 1.10 or later)')
+
+    # with torchrun, every process trains on its own shard of the data;
+    # only rank 0 logs and writes checkpoints
+    rank, world_size = init_distributed(args.dist_backend)
+    distributed, is_main = world_size > 1, rank == 0
+    if is_main:
+        print(args)
+
+    if args.resume:
+        # continue in the directory of the checkpoint
+        ckpt = torch.load(args.resume, map_location='cpu')
+        out_dir = Path(args.resume).parent
+        args.seed = ckpt['args']['seed']
+    elif is_main:
+        out_dir = init_experiment(args, "LayoutGAN++")
+    if distributed:
+        # share the seed, name and directory chosen by rank 0; each rank
+        # draws its own noise
+        if not args.resume:
+            shared = [(args.seed, args.name, out_dir) if is_main else None]
+            dist.broadcast_object_list(shared, src=0)
+            args.seed, args.name, out_dir = shared[0]
+        set_seed(args.seed + rank)
+    writer = SummaryWriter(out_dir) if is_main else None
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if distributed and device.type == 'cuda':
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
 
-    # load dataset
-    transforms = [LexicographicSort()]
+    # load dataset; augmentation runs on the collated batches on device,
+    # see below
+    transforms = [BatchLexicographicSort()]
     if args.aug_flip:
-        transforms = [T.RandomApply([HorizontalFlip()], 0.5)] + transforms
-
-    train_dataset = get_dataset(args.dataset, 'train',
-                                transform=T.Compose(transforms))
-    train_dataloader = DataLoader(train_dataset,
-                                  batch_size=args.batch_size,
-                                  num_workers=4,
-                                  pin_memory=True,
-                                  shuffle=True)
-
-    val_dataset = get_dataset(args.dataset, 'val')
-    val_dataloader = DataLoader(val_dataset,
-                                batch_size=args.batch_size,
-                                num_workers=4,
-                                pin_memory=True,
-                                shuffle=False)
+        transforms = [BatchHorizontalFlip(0.5)] + transforms
+
+    # rank 0 processes the raw data if needed, the others wait for it;
+    # the validation split is only used by the validation worker
+    if distributed and not is_main:
+        dist.barrier()
+    load_dataset = get_dense_dataset if args.dense_data else get_dataset
+    train_dataset = load_dataset(args.dataset, 'train')
+    load_dataset(args.dataset, 'val')
+    if distributed and is_main:
+        dist.barrier()
+
+    train_sampler = None
+    if args.bucket_by_length:
+        train_sampler = BucketBatchSampler(get_lengths(train_dataset),
+                                           args.batch_size, shuffle=True,
+                                           max_tokens=args.max_tokens,
+                                           seed=args.seed if distributed
+                                           else None,
+                                           num_replicas=world_size,
+                                           rank=rank)
+        train_dataloader = get_dataloader(train_dataset,
+                                          batch_sampler=train_sampler,
+                                          num_workers=4,
+                                          pin_memory=True)
+    elif distributed:
+        train_sampler = DistributedSampler(train_dataset, world_size, rank,
+                                           shuffle=True, seed=args.seed)
+        train_dataloader = get_dataloader(train_dataset,
+                                          batch_size=args.batch_size,
+                                          sampler=train_sampler,
+                                          num_workers=4,
+                                          pin_memory=True)
+    else:
+        train_dataloader = get_dataloader(train_dataset,
+                                          batch_size=args.batch_size,
+                                          num_workers=4,
+                                          pin_memory=True,
+                                          shuffle=True)
 
     num_label = train_dataset.num_classes
 
@@ -99,83 +202,220 @@ def main():
                          num_layers=args.D_num_layers,
                          ).to(device)
 
-    # prepare for evaluation
+    # prepare for evaluation; the validation split is evaluated by a
+    # separate process on snapshots of netG, see validation.py
     fid_train = LayoutFID(args.dataset, device)
-    fid_val = LayoutFID(args.dataset, device)
+    validator = None
+    if is_main:
+        validator = ValidationWorker(args, args.val_device or device)
 
     fixed_label = None
-    val_layouts = [(data.x.numpy(), data.y.numpy()) for data in val_dataset]
 
     # setup optimizer
     optimizerD = optim.Adam(netD.parameters(), lr=args.lr)
     optimizerG = optim.Adam(netG.parameters(), lr=args.lr)
 
-    iteration = 0
+    # the training steps go through trainG/trainD, which are wrapped in
+    # DistributedDataParallel when distributed and compiled with
+    # --compile; netG/netD are used for evaluation and checkpoints.
+    # the G step runs the discriminator as localD, so that only the
+    # gradients of G are all-reduced there
+    trainG, trainD, localD = netG, netD, netD
+    if distributed:
+        device_ids = [device] if device.type == 'cuda' else None
+        trainG = DistributedDataParallel(netG, device_ids)
+        trainD = DistributedDataParallel(netD, device_ids)
+    if args.compile:
+        trainG = torch.compile(trainG, dynamic=True)
+        trainD = torch.compile(trainD, dynamic=True)
+        localD = torch.compile(netD, dynamic=True)
+
+    # fp16 needs gradient scaling against underflow, bf16 has the range
+    # of fp32 and does not
+    amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(args.amp)
+    if amp_dtype == torch.float16 and device.type != 'cuda':
+        if is_main:
+            print('--amp fp16 is only used on CUDA, training in fp32')
+        amp_dtype = None
+    autocast = get_autocast(device, amp_dtype) if amp_dtype else nullcontext
+    scalerG = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    scalerD = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
+    # training values are summed on device and only read at logging points
+    log_keys = ['Loss_D', 'Loss_G', 'Loss_D_fake', 'Loss_D_real',
+                'Loss_D_recl', 'Loss_D_recb', 'real', 'fake']
+    log_sum = torch.zeros(len(log_keys), device=device)
+    log_count, num_samples, log_time = 0, 0, time.perf_counter()
+
+    iteration, start_epoch = 0, 0
     last_eval, best_iou = -1e+8, -1e+8
+    if args.resume:
+        netG.load_state_dict(ckpt['netG'])
+        netD.load_state_dict(ckpt['netD'])
+        optimizerG.load_state_dict(ckpt['optimizerG'])
+        optimizerD.load_state_dict(ckpt['optimizerD'])
+        if ckpt.get('scalerG'):
+            # empty when saved without fp16, the scalers then start fresh
+            scalerG.load_state_dict(ckpt['scalerG'])
+            scalerD.load_state_dict(ckpt['scalerD'])
+        start_epoch, best_iou = ckpt['epoch'], ckpt['best_iou']
+        iteration = ckpt.get('iteration', 0)
+        last_eval = ckpt.get('last_eval', last_eval)
+        # snapshots validated after the checkpoint was written may have
+        # updated the best model
+        best_path = out_dir / 'model_best.pth.tar'
+        if best_path.exists():
+            best = torch.load(best_path, map_location='cpu')
+            best_iou = max(best_iou, best['best_iou'])
+            del best
+        if 'rng' in ckpt:
+            # one state per rank for distributed runs
+            rng = ckpt['rng']
+            set_rng_state(rng[rank] if isinstance(rng, list) else rng)
+        if is_main:
+            print(f'Resumed from {args.resume} at epoch {start_epoch}, '
+                  f'iteration {iteration}')
+
+    def get_checkpoint(epoch, rng):
+        return {
+            'args': vars(args),
+            'epoch': epoch + 1,
+            'iteration': iteration,
+            'last_eval': last_eval,
+            'netG': netG.state_dict(),
+            'netD': netD.state_dict(),
+            'best_iou': best_iou,
+            'optimizerG': optimizerG.state_dict(),
+            'optimizerD': optimizerD.state_dict(),
+            'scalerG': scalerG.state_dict(),
+            'scalerD': scalerD.state_dict(),
+            'rng': rng,
+        }
+
+    def save_checkpoint(epoch):
+        # called on all ranks: the RNG states are gathered from each.
+        # returns the saved state on rank 0
+        rng = all_gather_object(get_rng_state())
+        if is_main:
+            return checkpoint_writer.save(get_checkpoint(epoch, rng[0] if
+                                                         len(rng) == 1
+                                                         else rng),
+                                          False, out_dir)
+
+    # snapshots sent to the validation worker: iteration ->
+    # (epoch, fid_score_train, saved state)
+    snapshots = {}
+
+    def log_validation(results):
+        # scores of the validation worker, as they arrive; the best
+        # snapshot is written as model_best.pth.tar
+        nonlocal best_iou
+        for it, fid_score_val, max_iou_val in results:
+            epoch_val, fid_score_train, state = snapshots.pop(it)
+            writer.add_scalar('Epoch', epoch_val, it)
+            tag_scalar_dict = {'train': fid_score_train,
+                               'val': fid_score_val}
+            writer.add_scalars('Score/Layout FID', tag_scalar_dict, it)
+            writer.add_scalar('Score/Maximum IoU', max_iou_val, it)
+
+            if best_iou < max_iou_val:
+                best_iou = max_iou_val
+                checkpoint_writer.save_best(dict(state, best_iou=best_iou),
+                                            out_dir)
+
+    # checkpoints are written in the background
+    checkpoint_writer = CheckpointWriter()
+    last_save = iteration
     max_epoch = args.iteration * args.batch_size / len(train_dataset)
+    if distributed or (args.bucket_by_length and args.max_tokens is not None):
+        # batch sizes vary with the layout length, or every iteration
+        # takes one batch on each rank
+        max_epoch = args.iteration / len(train_dataloader)
     max_epoch = int(torch.ceil(torch.tensor(max_epoch)).item())
-    for epoch in range(max_epoch):
+    for epoch in range(start_epoch, max_epoch):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         netG.train(), netD.train()
         for i, data in enumerate(train_dataloader):
-            data = data.to(device)
-            label, mask = to_dense_batch(data.y, data.batch)
-            bbox_real, _ = to_dense_batch(data.x, data.batch)
+            bbox_real, label, mask = get_dense_batch(data, device)
+            for transform in transforms:
+                bbox_real, label, mask = transform(bbox_real, label, mask)
             padding_mask = ~mask
             z = torch.randn(label.size(0), label.size(1),
                             args.latent_size, device=device)
 
             # Update G network
             netG.zero_grad()
-            bbox_fake = netG(z, label, padding_mask)
-            D_fake = netD(bbox_fake, label, padding_mask)
-            loss_G = F.softplus(-D_fake).mean()
-            loss_G.backward()
-            optimizerG.step()
-
-            # Update D network
+            with autocast():
+                bbox_fake = trainG(z, label, padding_mask)
+                D_fake = localD(bbox_fake, label, padding_mask)
+                loss_G = F.softplus(-D_fake).mean()
+            scalerG.scale(loss_G).backward()
+            scalerG.step(optimizerG)
+            scalerG.update()
+
+            # Update D network; the fake and real terms are backpropagated
+            # separately (one D forward per backward, as DDP expects) and
+            # the gradients are all-reduced once, after the real term
             netD.zero_grad()
-            D_fake = netD(bbox_fake.detach(), label, padding_mask)
-            loss_D_fake = F.softplus(D_fake).mean()
-
-            D_real, logit_cls, bbox_recon = \
-                netD(bbox_real, label, padding_mask, reconst=True)
-            loss_D_real = F.softplus(-D_real).mean()
-            loss_D_recl = F.cross_entropy(logit_cls, data.y)
-            loss_D_recb = F.mse_loss(bbox_recon, data.x)
-
-            loss_D = loss_D_real + loss_D_fake
-            loss_D += loss_D_recl + 10 * loss_D_recb
-            loss_D.backward()
-            optimizerD.step()
-
+            with no_sync(trainD):
+                with autocast():
+                    D_fake = trainD(bbox_fake.detach(), label, padding_mask)
+                    loss_D_fake = F.softplus(D_fake).mean()
+                scalerD.scale(loss_D_fake).backward()
+
+            with autocast():
+                D_real, logit_cls, bbox_recon = \
+                    trainD(bbox_real, label, padding_mask, reconst=True)
+                loss_D_real = F.softplus(-D_real).mean()
+                loss_D_recl = F.cross_entropy(logit_cls, label[mask])
+                loss_D_recb = F.mse_loss(bbox_recon, bbox_real[mask])
+                loss_D_rest = loss_D_real + loss_D_recl + 10 * loss_D_recb
+            scalerD.scale(loss_D_rest).backward()
+            loss_D = loss_D_rest.detach() + loss_D_fake.detach()
+            scalerD.step(optimizerD)
+            scalerD.update()
+
+            bbox_fake = bbox_fake.float()
             fid_train.collect_features(bbox_fake, label, padding_mask)
             fid_train.collect_features(bbox_real, label, padding_mask,
                                        real=True)
 
-            if iteration % 50 == 0:
-                D_real = torch.sigmoid(D_real).mean().item()
-                D_fake = torch.sigmoid(D_fake).mean().item()
-                loss_D, loss_G = loss_D.item(), loss_G.item()
-                loss_D_fake, loss_D_real = loss_D_fake.item(), loss_D_real.item()
-                loss_D_recl, loss_D_recb = loss_D_recl.item(), loss_D_recb.item()
+            log_sum += torch.stack([
+                loss_D, loss_G, loss_D_fake, loss_D_real,
+                loss_D_recl, loss_D_recb,
+                torch.sigmoid(D_real).mean(), torch.sigmoid(D_fake).mean(),
+            ]).detach().float()
+            log_count += 1
+            num_samples += label.size(0)
+
+            if iteration % 50 == 0 and is_main:
+                log_validation(validator.poll())
+
+                # values of rank 0, averaged over the iterations since the
+                # last logging point; this is the only sync with the device
+                logs = dict(zip(log_keys, (log_sum / log_count).tolist()))
+                log_sum.zero_()
+                now = time.perf_counter()
+                throughput = num_samples * world_size / (now - log_time)
+                log_count, num_samples, log_time = 0, 0, now
 
                 print('\t'.join([
                     f'[{epoch}/{max_epoch}][{i}/{len(train_dataloader)}]',
-                    f'Loss_D: {loss_D:E}', f'Loss_G: {loss_G:E}',
-                    f'Real: {D_real:.3f}', f'Fake: {D_fake:.3f}',
+                    f'Loss_D: {logs["Loss_D"]:E}',
+                    f'Loss_G: {logs["Loss_G"]:E}',
+                    f'Real: {logs["real"]:.3f}', f'Fake: {logs["fake"]:.3f}',
+                    f'Samples/s: {throughput:.1f}',
                 ]))
 
                 # add data to tensorboard
-                tag_scalar_dict = {'real': D_real, 'fake': D_fake}
+                tag_scalar_dict = {'real': logs['real'], 'fake': logs['fake']}
                 writer.add_scalars('Train/D_value', tag_scalar_dict, iteration)
-                writer.add_scalar('Train/Loss_D', loss_D, iteration)
-                writer.add_scalar('Train/Loss_D_fake', loss_D_fake, iteration)
-                writer.add_scalar('Train/Loss_D_real', loss_D_real, iteration)
-                writer.add_scalar('Train/Loss_D_recl', loss_D_recl, iteration)
-                writer.add_scalar('Train/Loss_D_recb', loss_D_recb, iteration)
-                writer.add_scalar('Train/Loss_G', loss_G, iteration)
-
-            if iteration % 5000 == 0:
+                for key in log_keys[:6]:
+                    writer.add_scalar(f'Train/{key}', logs[key], iteration)
+                writer.add_scalar('Train/Throughput', throughput, iteration)
+
+            if iteration % 5000 == 0 and is_main:
                 out_path = out_dir / f'real_samples.png'
                 if not out_path.exists():
                     save_image(bbox_real, label, mask,
@@ -196,59 +436,30 @@ def main():
 
             iteration += 1
 
+        fid_train.all_reduce()
         fid_score_train = fid_train.compute_score()
 
         if epoch != max_epoch - 1:
             if iteration - last_eval < 1e+4:
+                if iteration - last_save >= args.save_interval:
+                    save_checkpoint(epoch)
+                    last_save = iteration
                 continue
 
-        # validation
+        # validation; training goes on while the worker evaluates the
+        # snapshot, its scores are logged by log_validation()
         last_eval = iteration
-        fake_layouts = []
-        netG.eval(), netD.eval()
-        with torch.no_grad():
-            for i, data in enumerate(val_dataloader):
-                data = data.to(device)
-                label, mask = to_dense_batch(data.y, data.batch)
-                bbox_real, _ = to_dense_batch(data.x, data.batch)
-                padding_mask = ~mask
-                z = torch.randn(label.size(0), label.size(1),
-                                args.latent_size, device=device)
-
-                bbox_fake = netG(z, label, padding_mask)
-
-                fid_val.collect_features(bbox_fake, label, padding_mask)
-                fid_val.collect_features(bbox_real, label, padding_mask,
-                                         real=True)
-
-                # collect generated layouts
-                for j in range(label.size(0)):
-                    _mask = mask[j]
-                    b = bbox_fake[j][_mask].cpu().numpy()
-                    l = label[j][_mask].cpu().numpy()
-                    fake_layouts.append((b, l))
-
-        fid_score_val = fid_val.compute_score()
-        max_iou_val = compute_maximum_iou(val_layouts, fake_layouts)
-
-        writer.add_scalar('Epoch', epoch, iteration)
-        tag_scalar_dict = {'train': fid_score_train, 'val': fid_score_val}
-        writer.add_scalars('Score/Layout FID', tag_scalar_dict, iteration)
-        writer.add_scalar('Score/Maximum IoU', max_iou_val, iteration)
-
-        # do checkpointing
-        is_best = best_iou < max_iou_val
-        best_iou = max(max_iou_val, best_iou)
-
-        save_checkpoint({
-            'args': vars(args),
-            'epoch': epoch + 1,
-            'netG': netG.state_dict(),
-            'netD': netD.state_dict(),
-            'best_iou': best_iou,
-            'optimizerG': optimizerG.state_dict(),
-            'optimizerD': optimizerD.state_dict(),
-        }, is_best, out_dir)
+        state = save_checkpoint(epoch)
+        last_save = iteration
+        if is_main:
+            snapshots[iteration] = (epoch, fid_score_train, state)
+            validator.submit(iteration, state['netG'])
+            log_validation(validator.poll())
+
+    checkpoint_writer.wait()
+    if is_main:
+        log_validation(validator.close())
+        checkpoint_writer.wait()
 
 
 if __name__ == "__main__":
@@ -1,14 +1,16 @@
+import os
 import json
+import hashlib
 import random
 import shutil
+import threading
 import numpy as np
 from pathlib import Path
 from datetime import datetime
+from collections import OrderedDict
 from PIL import Image, ImageDraw
 
 import torch
-import torchvision.utils as vutils
-import torchvision.transforms as T
 
 
 def set_seed(seed):
@@ -18,6 +20,12 @@ def set_seed(seed):
     print("Random Seed:", seed)
 
 
+def derive_seed(*keys):
+    # an independent seed for every tuple of integer keys, e.g.
+    # (seed, batch index), that does not depend on the order of use
+    return int(np.random.SeedSequence(keys).generate_state(1)[0])
+
+
 def init_experiment(args, prefix):
     if args.seed is None:
         args.seed = random.randint(0, 10000)
@@ -37,13 +45,240 @@ def init_experiment(args, prefix):
     return out_dir
 
 
+def init_distributed(backend='gloo'):
+    # set up torch.distributed from the environment set by torchrun (or
+    # torch.distributed.launch --use_env); returns (rank, world_size)
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+
+    import torch.distributed as dist
+    dist.init_process_group(backend, init_method='env://')
+    return dist.get_rank(), dist.get_world_size()
+
+
+def all_gather_object(obj):
+    # obj of every process, or [obj] when torch.distributed is not used
+    import torch.distributed as dist
+    if not dist.is_available() or not dist.is_initialized():
+        return [obj]
+
+    out = [None] * dist.get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _atomic_save(obj, out_path):
+    # write next to the target and rename, so that a crash never leaves
+    # a partial checkpoint behind
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, out_path)
+
+
 def save_checkpoint(state, is_best, out_dir):
     out_path = Path(out_dir) / 'checkpoint.pth.tar'
-    torch.save(state, out_path)
+    _atomic_save(state, out_path)
 
     if is_best:
         best_path = Path(out_dir) / 'model_best.pth.tar'
-        shutil.copyfile(out_path, best_path)
+        tmp_path = best_path.with_name(best_path.name + '.tmp')
+        shutil.copyfile(out_path, tmp_path)
+        os.replace(tmp_path, best_path)
+
+
+def _copy_to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _copy_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter():
+    # save_checkpoint() from a background thread: the state is copied to
+    # the CPU before save() returns, so training can go on while the file
+    # is written. only one write is in flight, a new save() waits for the
+    # previous one
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except BaseException as e:
+            self._error = e
+
+    def _start(self, fn, *args):
+        self.wait()
+        self._thread = threading.Thread(target=self._run, args=(fn,) + args)
+        self._thread.start()
+
+    def save(self, state, is_best, out_dir):
+        # returns the CPU copy of state, which must not be modified
+        state = _copy_to_cpu(state)
+        self._start(save_checkpoint, state, is_best, out_dir)
+        return state
+
+    def save_best(self, state, out_dir):
+        # a state that was validated after it was saved, e.g. by
+        # validation.ValidationWorker
+        state = _copy_to_cpu(state)
+        self._start(_atomic_save, state, Path(out_dir) / 'model_best.pth.tar')
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def get_file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with Path(path).open('rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+WEIGHTS_MAGIC = b'LGPPWTS1'
+WEIGHTS_ALIGN = 64
+
+
+def get_weights_path(ckpt_path):
+    # pretrained/foo.pth.tar -> pretrained/foo.weights
+    ckpt_path = Path(ckpt_path)
+    name = ckpt_path.name.split('.')[0]
+    return ckpt_path.with_name(name + '.weights')
+
+
+def is_weights_file(path):
+    with Path(path).open('rb') as f:
+        return f.read(len(WEIGHTS_MAGIC)) == WEIGHTS_MAGIC
+
+
+def export_weights(ckpt, out_path, keys=('netG', 'netD')):
+    # keep only the inference weights and training args of a checkpoint
+    # and write them as one flat file: magic, header size, JSON header
+    # (args + dtype/shape/offset per tensor), then aligned raw tensor data
+    tensors, offset = {}, 0
+    for key in keys:
+        for name, t in ckpt[key].items():
+            t = t.detach().cpu().contiguous()
+            offset = -(-offset // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+            tensors[f'{key}.{name}'] = (offset, t)
+            offset += t.numel() * t.element_size()
+
+    header = {
+        'args': ckpt['args'],
+        'tensors': {
+            name: {
+                'dtype': str(t.numpy().dtype),
+                'shape': list(t.size()),
+                'offset': o,
+            } for name, (o, t) in tensors.items()
+        },
+    }
+    header = json.dumps(header).encode('utf-8')
+    data_start = len(WEIGHTS_MAGIC) + 8 + len(header)
+    data_start = -(-data_start // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+
+    with Path(out_path).open('wb') as f:
+        f.write(WEIGHTS_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for o, t in tensors.values():
+            f.seek(data_start + o)
+            f.write(t.numpy().tobytes())
+
+
+def load_weights(path):
+    # map an exported weight file without reading it: the file is opened
+    # read-only with a private mapping, so every process that loads it
+    # shares the same page cache pages
+    with Path(path).open('rb') as f:
+        if f.read(len(WEIGHTS_MAGIC)) != WEIGHTS_MAGIC:
+            raise ValueError(f'{path} is not an exported weight file')
+        size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(size).decode('utf-8'))
+    data_start = len(WEIGHTS_MAGIC) + 8 + size
+    data_start = -(-data_start // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+
+    buf = np.memmap(path, dtype=np.uint8, mode='c')
+    ckpt = {'args': header['args']}
+    for name, meta in header['tensors'].items():
+        dtype = np.dtype(meta['dtype'])
+        begin = data_start + meta['offset']
+        end = begin + int(np.prod(meta['shape'])) * dtype.itemsize
+        array = buf[begin:end].view(dtype).reshape(meta['shape'])
+        key, name = name.split('.', 1)
+        ckpt.setdefault(key, OrderedDict())[name] = torch.from_numpy(array)
+    return ckpt
+
+
+def load_checkpoint(ckpt_path, device='cpu'):
+    if not is_weights_file(ckpt_path):
+        return torch.load(ckpt_path, map_location=device)
+
+    ckpt = load_weights(ckpt_path)
+    for key, state_dict in ckpt.items():
+        if key != 'args':
+            for name, t in state_dict.items():
+                state_dict[name] = t.to(device)
+    return ckpt
+
+
+def assign_state_dict(module, state_dict):
+    # same as module.load_state_dict(), but the module takes over the given
+    # tensors instead of copying into its own, so memory-mapped weights stay
+    # backed by the mapping
+    expected = module.state_dict()
+    if set(expected.keys()) != set(state_dict.keys()):
+        missing = set(expected.keys()) - set(state_dict.keys())
+        unexpected = set(state_dict.keys()) - set(expected.keys())
+        raise RuntimeError(f'Error(s) in assigning state_dict: '
+                           f'missing {sorted(missing)}, '
+                           f'unexpected {sorted(unexpected)}')
+
+    for key, t in state_dict.items():
+        if expected[key].size() != t.size():
+            raise RuntimeError(f'size mismatch for {key}: '
+                               f'{tuple(t.size())} vs '
+                               f'{tuple(expected[key].size())}')
+        *path, name = key.split('.')
+        m = module
+        for p in path:
+            m = getattr(m, p)
+        if name in m._parameters:
+            requires_grad = m._parameters[name].requires_grad
+            m._parameters[name] = torch.nn.Parameter(t, requires_grad)
+        else:
+            m._buffers[name] = t
+    return module
 
 
 def convert_xywh_to_ltrb(bbox):
@@ -55,28 +290,148 @@ def convert_xywh_to_ltrb(bbox):
     return [x1, y1, x2, y2]
 
 
-def convert_layout_to_image(boxes, labels, colors, canvas_size):
+def render_layouts(batch_boxes, batch_labels, batch_mask, colors,
+                   canvas_size):
+    # rasterizes a batch of layouts together with tensor ops, on the
+    # device of batch_boxes. the rectangles are those of
+    # convert_layout_to_image: drawn from the largest box, filled with the
+    # label color at alpha 100 and outlined with the opaque color.
+    # every step draws the k-th box of all layouts at once and only
+    # touches the pixels inside those boxes
+    # batch_boxes: [B, N, 4]
+    # batch_labels: [B, N]
+    # batch_mask: [B, N]
+    # returns uint8 [B, H, W, 3]
+    H, W = int(canvas_size[0]), int(canvas_size[1])
+    boxes = torch.as_tensor(batch_boxes).float()
+    device = boxes.device
+    labels = torch.as_tensor(batch_labels, device=device).long()
+    mask = torch.as_tensor(batch_mask, device=device).bool()
+    colors = torch.tensor(colors, dtype=torch.int32, device=device)
+    B, N = mask.shape
+
+    # drawing order: larger area first, ties in element order as sorted();
+    # padding elements last. rank i = #{larger} + #{equal before i}
+    area = (boxes[..., 2] * boxes[..., 3]).masked_fill(~mask, -1)
+    larger = area[:, None, :] > area[:, :, None]
+    before = torch.ones(N, N, dtype=torch.bool, device=device).tril(-1)
+    equal = (area[:, None, :] == area[:, :, None]) & before
+    rank = (larger | equal).sum(dim=2)
+    order = torch.empty_like(rank).scatter_(
+        1, rank, torch.arange(N, device=device).expand(B, N))
+    boxes = boxes.gather(1, order[..., None].expand(B, N, 4))
+    color = colors[labels.gather(1, order)]
+    valid = mask.gather(1, order)
+
+    # pixel coordinates, truncated like PIL does, and the visible part
+    x1, y1, x2, y2 = convert_xywh_to_ltrb(boxes.permute(2, 0, 1))
+    x1, x2 = (x1 * (W - 1)).long(), (x2 * (W - 1)).long()
+    y1, y2 = (y1 * (H - 1)).long(), (y2 * (H - 1)).long()
+    vx1, vx2 = x1.clamp(0, W - 1), x2.clamp(0, W - 1)
+    vy1, vy2 = y1.clamp(0, H - 1), y2.clamp(0, H - 1)
+    width = (vx2 - vx1 + 1) * ((x2 >= 0) & (x1 < W) & valid)
+    height = (vy2 - vy1 + 1) * ((y2 >= 0) & (y1 < H))
+    num_pixels = width * height
+
+    # per box: first pixel and width of the visible part, outline
+    # coordinates relative to it and color, expanded to the pixels of
+    # the box below
+    first = (torch.arange(B, device=device)[:, None] * H + vy1) * W + vx1
+    attrs = torch.stack([first, width, x1 - vx1, x2 - vx1,
+                         y1 - vy1, y2 - vy1], dim=2)
+    attrs = torch.cat([attrs, color.long()], dim=2)
+
+    img = torch.full((B * H * W, 3), 255, dtype=torch.int32, device=device)
+    for k in range(N):
+        n = num_pixels[:, k]
+        total = int(n.sum())
+        if total == 0:
+            continue
+
+        # flat indices of the pixels in the k-th box of every layout
+        start = n.cumsum(0) - n
+        a = torch.cat([attrs[:, k], start[:, None]], dim=1) \
+            .repeat_interleave(n, dim=0)
+        first, w, bx1, bx2, by1, by2 = a[:, :6].unbind(1)
+        local = torch.arange(total, device=device) - a[:, 9]
+        y, x = local // w, local % w
+        pixel = first + y * W + x
+
+        # (img * 155 + color * 100) / 255, rounded as in PIL
+        c = a[:, 6:9].int()
+        fill = img.index_select(0, pixel) * 155 + c * 100 + 128
+        fill = (fill + (fill >> 8)) >> 8
+        border = (x == bx1) | (x == bx2) | (y == by1) | (y == by2)
+        img.index_copy_(0, pixel, torch.where(border[:, None], c, fill))
+
+    return img.view(B, H, W, 3).to(torch.uint8)
+
+
+_index_glyphs = {}
+
+
+def _get_index_glyph(text):
+    # alpha mask of an element number drawn as in convert_layout_to_image,
+    # and the offset of its top left pixel from the anchor point
+    if text not in _index_glyphs:
+        size = 64
+        img = Image.new('L', (size, size), 0)
+        ImageDraw.Draw(img).text((size // 2, size // 2), text,
+                                 fill=255, anchor='mm')
+        glyph = np.asarray(img)
+        ys, xs = np.nonzero(glyph)
+        if len(ys) == 0:
+            ys, xs = np.zeros(1, dtype=int), np.zeros(1, dtype=int)
+        glyph = glyph[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+        _index_glyphs[text] = glyph, (ys.min() - size // 2,
+                                      xs.min() - size // 2)
+    return _index_glyphs[text]
+
+
+def draw_indices(images, batch_boxes, batch_mask, canvas_size):
+    # writes the element numbers at the box centers in black into
+    # images (uint8 [B, H, W, 3], numpy), in place. every number is
+    # rendered once and pasted into all layouts together
     H, W = canvas_size
-    img = Image.new('RGB', (int(W), int(H)), color=(255, 255, 255))
-    draw = ImageDraw.Draw(img, 'RGBA')
-
-    # draw from larger boxes
-    area = [b[2] * b[3] for b in boxes]
-    indices = sorted(range(len(area)),
-                     key=lambda i: area[i],
-                     reverse=True)
-
-    for i in indices:
-        bbox, color = boxes[i], colors[labels[i]]
-        c_fill = color + (100,)
-        x1, y1, x2, y2 = convert_xywh_to_ltrb(bbox)
-        x1, x2 = x1 * (W - 1), x2 * (W - 1)
-        y1, y2 = y1 * (H - 1), y2 * (H - 1)
-        draw.rectangle([x1, y1, x2, y2],
-                       outline=color,
-                       fill=c_fill)
-        draw.text(((x1+x2)/2, (y1+y2)/2), str(i + 1), fill=(0,0,0), anchor='mm')
-    return img
+    boxes = torch.as_tensor(batch_boxes).cpu().numpy()
+    mask = torch.as_tensor(batch_mask).cpu().numpy()
+    x1, y1, x2, y2 = convert_xywh_to_ltrb(boxes.transpose(2, 0, 1))
+    cx = ((x1 * (W - 1) + x2 * (W - 1)) / 2).astype(np.int64)
+    cy = ((y1 * (H - 1) + y2 * (H - 1)) / 2).astype(np.int64)
+
+    for i in range(mask.shape[1]):
+        b = np.nonzero(mask[:, i])[0]
+        glyph, (oy, ox) = _get_index_glyph(str(i + 1))
+        gh, gw = glyph.shape
+        y = cy[b, i, None, None] + oy + np.arange(gh)[None, :, None]
+        x = cx[b, i, None, None] + ox + np.arange(gw)[None, None, :]
+        b, y, x, alpha = np.broadcast_arrays(b[:, None, None], y, x,
+                                             glyph[None])
+        keep = (alpha > 0) & (y >= 0) & (y < H) & (x >= 0) & (x < W)
+        b, y, x = b[keep], y[keep], x[keep]
+        alpha = alpha[keep].astype(np.int32)[:, None]
+
+        # black blended with the glyph alpha, rounded as in PIL
+        value = images[b, y, x].astype(np.int32) * (255 - alpha) + 128
+        images[b, y, x] = (value + (value >> 8)) >> 8
+
+
+def convert_layouts_to_images(batch_boxes, batch_labels, batch_mask,
+                              colors, canvas_size):
+    # list of B PIL images, rasterized together by render_layouts(); the
+    # element numbers are drawn on top of all boxes
+    images = render_layouts(batch_boxes, batch_labels, batch_mask,
+                            colors, canvas_size).cpu().numpy()
+    draw_indices(images, batch_boxes, batch_mask, canvas_size)
+    return [Image.fromarray(image) for image in images]
+
+
+def convert_layout_to_image(boxes, labels, colors, canvas_size):
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(1, -1, 4)
+    labels = np.asarray(labels, dtype=np.int64).reshape(1, -1)
+    mask = np.ones(labels.shape, dtype=bool)
+    return convert_layouts_to_images(boxes, labels, mask,
+                                     colors, canvas_size)[0]
 
 
 def save_image(batch_boxes, batch_labels, batch_mask,
@@ -85,21 +440,26 @@ def save_image(batch_boxes, batch_labels, batch_mask,
     # batch_boxes: [B, N, 4]
     # batch_labels: [B, N]
     # batch_mask: [B, N]
-
-    imgs = []
-    B = batch_boxes.size(0)
-    to_tensor = T.ToTensor()
-    for i in range(B):
-        mask_i = batch_mask[i]
-        boxes = batch_boxes[i][mask_i]
-        labels = batch_labels[i][mask_i]
-        img = convert_layout_to_image(boxes, labels,
-                                      dataset_colors,
-                                      canvas_size)
-        imgs.append(to_tensor(img))
-    image = torch.stack(imgs)
+    images = render_layouts(batch_boxes, batch_labels, batch_mask,
+                            dataset_colors, canvas_size).cpu().numpy()
+    draw_indices(images, batch_boxes, batch_mask, canvas_size)
+    B, H, W, _ = images.shape
 
     if nrow is None:
         nrow = int(np.ceil(np.sqrt(B)))
 
-    vutils.save_image(image, out_path, normalize=False, nrow=nrow)
+    # grid with 2px black padding, as torchvision.utils.save_image
+    if B == 1:
+        grid = images[0]
+    else:
+        ncol = min(nrow, B)
+        nrows = -(-B // ncol)
+        grid = np.zeros((nrows, H + 2, ncol, W + 2, 3), dtype=np.uint8)
+        tiles = np.zeros((nrows * ncol, H, W, 3), dtype=np.uint8)
+        tiles[:B] = images
+        grid[:, 2:, :, 2:] = tiles.reshape(nrows, ncol, H, W, 3) \
+            .transpose(0, 2, 1, 3, 4)
+        grid = np.pad(grid.reshape(nrows * (H + 2), ncol * (W + 2), 3),
+                      ((0, 2), (0, 2), (0, 0)))
+
+    Image.fromarray(grid).save(out_path)
@@ -0,0 +1,162 @@
+import queue
+import atexit
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from data import get_dataset, get_dense_dataset, get_dataloader, \
+    get_dense_batch
+from metric import LayoutFID, compute_maximum_iou
+from model.layoutganpp import Generator
+
+
+def validate(netG, val_dataloader, fid_val, val_layouts, latent_size,
+             device):
+    # Layout FID and Max. IoU of netG on the validation split
+    fake_layouts = []
+    netG.eval()
+    with torch.no_grad():
+        for data in val_dataloader:
+            bbox_real, label, mask = get_dense_batch(data, device)
+            padding_mask = ~mask
+            z = torch.randn(label.size(0), label.size(1),
+                            latent_size, device=device)
+
+            bbox_fake = netG(z, label, padding_mask)
+
+            fid_val.collect_features(bbox_fake, label, padding_mask)
+            fid_val.collect_features(bbox_real, label, padding_mask,
+                                     real=True)
+
+            # collect generated layouts
+            for j in range(label.size(0)):
+                _mask = mask[j]
+                b = bbox_fake[j][_mask].cpu().numpy()
+                l = label[j][_mask].cpu().numpy()
+                fake_layouts.append((b, l))
+
+    fid_score_val = fid_val.compute_score()
+    max_iou_val = compute_maximum_iou(val_layouts, fake_layouts)
+    return fid_score_val, max_iou_val
+
+
+def _run_worker(args, device, jobs, results):
+    try:
+        device = torch.device(device)
+        if args['dense_data']:
+            val_dataset = get_dense_dataset(args['dataset'], 'val')
+            val_layouts = val_dataset.get_layouts()
+        else:
+            val_dataset = get_dataset(args['dataset'], 'val')
+            val_layouts = [(data.x.numpy(), data.y.numpy())
+                           for data in val_dataset]
+        val_dataloader = get_dataloader(val_dataset,
+                                        batch_size=args['batch_size'],
+                                        num_workers=4,
+                                        pin_memory=True,
+                                        shuffle=False)
+
+        netG = Generator(args['latent_size'], val_dataset.num_classes,
+                         d_model=args['G_d_model'],
+                         nhead=args['G_nhead'],
+                         num_layers=args['G_num_layers'],
+                         ).to(device)
+        fid_val = LayoutFID(args['dataset'], device)
+
+        parent = mp.parent_process()
+        while True:
+            try:
+                job = jobs.get(timeout=1)
+            except queue.Empty:
+                # stop if the training process died without close()
+                if not parent.is_alive():
+                    return
+                continue
+            if job is None:
+                return
+
+            iteration, state_dict = job
+            netG.load_state_dict(state_dict)
+            # every snapshot is evaluated with the same noise
+            torch.manual_seed(args['seed'])
+            fid_score_val, max_iou_val = validate(
+                netG, val_dataloader, fid_val, val_layouts,
+                args['latent_size'], device)
+            results.put((iteration, fid_score_val, max_iou_val))
+    except BaseException:
+        results.put(('error', traceback.format_exc()))
+
+
+class ValidationWorker():
+    # validates snapshots of the generator in a separate process while
+    # training continues. submit() hands over a copy of the weights and
+    # returns at once; the scores come back, in submission order, from
+    # poll() as (iteration, fid_score_val, max_iou_val). at most
+    # max_pending snapshots are queued, submit() waits for a result
+    # beyond that.
+    def __init__(self, args, device, max_pending=2):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.max_pending = max_pending
+        self.num_pending = 0
+        self.received = []
+
+        # not a daemon, so that the worker can start its own data loader
+        # and Max. IoU processes
+        self.process = ctx.Process(target=_run_worker,
+                                   args=(vars(args), str(device),
+                                         self.jobs, self.results))
+        self.process.start()
+        # do not leave it running if training fails before close()
+        atexit.register(self.terminate)
+
+    def _receive(self, block):
+        while True:
+            try:
+                result = self.results.get(block, timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('validation worker exited with code '
+                                       f'{self.process.exitcode}')
+                if not block:
+                    return
+                continue
+            if result[0] == 'error':
+                self.terminate()
+                raise RuntimeError(f'validation worker failed:\n{result[1]}')
+            self.received.append(result)
+            self.num_pending -= 1
+            return
+
+    def submit(self, iteration, state_dict):
+        while self.num_pending >= self.max_pending:
+            self._receive(block=True)
+        state_dict = {k: v.detach().to('cpu', copy=True)
+                      for k, v in state_dict.items()}
+        self.jobs.put((iteration, state_dict))
+        self.num_pending += 1
+
+    def poll(self):
+        while self.num_pending > 0:
+            num_pending = self.num_pending
+            self._receive(block=False)
+            if self.num_pending == num_pending:
+                break
+        received, self.received = self.received, []
+        return received
+
+    def close(self):
+        # wait for the pending snapshots and stop the worker
+        while self.num_pending > 0:
+            self._receive(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        received, self.received = self.received, []
+        return received
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()